@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+'''
+
+    Benchmarks for csefsck.py
+
+    python benchmark.py reconcile
+    ------------------------------------------------------------------------------------------------
+        Times the old list.count() scan from update_freeblock_list against the block map walk in
+        reconcile_blocks at 10k, 100k, and 1M blocks. 1% of the blocks are marked as in use.
+        The old scan is O(N*M), so above LEGACY_SAMPLE candidates it is timed on a sample and
+        scaled up linearly (marked with a '*' in the output).
+    ------------------------------------------------------------------------------------------------
+
+    python benchmark.py check [--blocks N --block-size B --depth D --fanout F --files N ...] [--history FILE]
+    ------------------------------------------------------------------------------------------------
+        Generates a filesystem with fsgen.py (in a temporary directory), then checks it with
+        csefsck.check_filesystem() in a child process and reports the wall time of each phase (and
+        with --timed-io the I/O and parse time), the throughput in blocks/sec, and the child's peak RSS. With --history the result is appended
+        as a JSON line tagged with the git version, so runs can be compared across versions.
+    ------------------------------------------------------------------------------------------------
+
+    python benchmark.py classify [--blocks N --block-size B --files N --leaked N ...]
+    ------------------------------------------------------------------------------------------------
+        Generates a filesystem of mixed blocks (directories, file inodes, index blocks, and data),
+        then times identifying every block and parsing the file inodes and index blocks with the
+        single-pass fast paths in fsparse.py against the parsers they replaced, which tried every
+        parser in turn and scanned each block several times (kept below as legacy_*).
+    ------------------------------------------------------------------------------------------------
+
+    python benchmark.py interpreters [--python2 PATH --python3 PATH] [--blocks N ...]
+    ------------------------------------------------------------------------------------------------
+        Generates one filesystem, then runs csefsck.py --check-only --stats on it under each
+        interpreter and prints the phase times side by side, with the Python 3 speedup.
+    ------------------------------------------------------------------------------------------------
+
+'''
+
+from __future__ import print_function
+
+from time import time
+from multiprocessing import Process, Queue
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import csefsck
+import fsgen
+import fsparse
+from fsstats import Stats
+
+try:
+    xrange
+except NameError: # Python 3
+    xrange = range
+
+SIZES         = [10000, 100000, 1000000] # filesystem sizes (in blocks) to benchmark
+USED_FRACTION = 0.01                     # fraction of the blocks that are marked as in use
+LEGACY_SAMPLE = 20000                    # most candidates the old O(N*M) scan is run over before extrapolating
+PHASES        = ['check_devId', 'check_superblock', 'check_tree', 'check_file_inodes', 'check_fields', 'update_freeblock_list', 'flush']
+
+
+# the original update_freeblock_list reconciliation: one list.count() per candidate block
+def legacy_reconcile(used_blocks, candidates):
+    used_blocks.sort()
+    free_blocks = []
+    for i in candidates:
+        if (used_blocks.count(i) == 0):
+            free_blocks.append(i)
+    return free_blocks
+
+
+# time the old and new reconciliation over a filesystem of num_blocks blocks and return (legacy_secs, map_secs, extrapolated)
+def bench_reconcile(num_blocks):
+    geometry = csefsck.Geometry(num_blocks)
+    first = geometry.root + 1
+    used = random.sample(xrange(first, num_blocks), int(num_blocks * USED_FRACTION))
+
+    # new: block map claims plus one linear walk
+    start = time()
+    block_map = csefsck.BlockMap(geometry)
+    for i in used:
+        block_map.claim(i, geometry.root)
+    free_blocks, cross_linked = csefsck.reconcile_blocks(block_map, geometry)
+    map_secs = time() - start
+
+    # old: list of used blocks and a count() per candidate, sampled if the full run would take too long
+    candidates = xrange(first, num_blocks)
+    extrapolated = len(candidates) > LEGACY_SAMPLE
+    if (extrapolated):
+        candidates = xrange(first, first + LEGACY_SAMPLE)
+    start = time()
+    legacy_free = legacy_reconcile(list(used), candidates)
+    legacy_secs = time() - start
+    if (extrapolated):
+        legacy_secs *= float(num_blocks - first) / LEGACY_SAMPLE
+    else:
+        assert legacy_free == free_blocks
+
+    return (legacy_secs, map_secs, extrapolated)
+
+
+def main_reconcile(args):
+    random.seed(0)
+    print("%10s %14s %14s %10s" % ("blocks", "list.count (s)", "block map (s)", "speedup"))
+    for num_blocks in SIZES:
+        legacy_secs, map_secs, extrapolated = bench_reconcile(num_blocks)
+        marker = '*' if extrapolated else ' '
+        print("%10d %13.3f%s %14.4f %9.0fx" % (num_blocks, legacy_secs, marker, map_secs, legacy_secs / map_secs))
+
+
+# the original parse_index_block: a strip() and an isdigit() per token
+def legacy_parse_index_block(contents):
+    blocks = []
+    for token in contents.split(b','):
+        token = token.strip()
+        if (not token.isdigit()):
+            return None
+        blocks.append(int(token))
+    return blocks
+
+
+# the original parse_file_inode: strip the block, check it for braces three times and for the directory key, then find every field
+def legacy_parse_file_inode(contents, num):
+    body = fsparse.strip_braces(contents, num)
+    if (b'{' in body or b'}' in body or fsparse.DIR_DICT_KEY in body):
+        raise fsparse.BlockFormatError("fusedata.%d does not contain inode data" % num)
+    return fsparse.parse_fields(fsparse.FileInode(), fsparse.FileInode.KEYS, body, num)
+
+
+# the original parse_dir, whose header went through the general field search
+def legacy_parse_dir(contents, num):
+    (body_start, body_end) = fsparse.brace_bounds(contents, 0, len(contents), num)
+    key = contents.find(fsparse.DIR_DICT_KEY, body_start, body_end)
+    colon = key + len(fsparse.DIR_DICT_KEY)
+    while (key >= 0 and colon < body_end and contents[colon:colon + 1].isspace()):
+        colon += 1
+    if (key < 0 or colon >= body_end or contents[colon:colon + 1] != b':'):
+        raise fsparse.BlockFormatError("fusedata.%d does not contain directory data" % num)
+    (dict_start, dict_end) = fsparse.brace_bounds(contents, colon + 1, body_end, num)
+    if (contents.find(b'{', body_start, key) >= 0 or contents.find(b'}', dict_start, dict_end) >= 0):
+        raise fsparse.BlockFormatError("fusedata.%d does not contain directory data" % num)
+    record = fsparse.parse_fields(fsparse.DirInode(), fsparse.DirInode.KEYS, contents[body_start:key], num)
+    record.entries = list(fsparse.iter_dir_entries(contents, num, dict_start, dict_end))
+    return record
+
+
+# the original block classification: try the directory parser, then the file inode parser, then the index block parser on every block
+def legacy_identify_block(contents, num):
+    for (kind, parse) in [('directory', legacy_parse_dir), ('file-inode', legacy_parse_file_inode)]:
+        try:
+            return (kind, parse(contents, num))
+        except fsparse.BlockFormatError:
+            pass
+    blocks = legacy_parse_index_block(contents)
+    if (blocks is not None):
+        return ('index', blocks)
+    return ('data', None)
+
+
+# return the fastest of repeat runs of f(), in seconds, and what it returned
+def best_time(f, repeat=3):
+    best = None
+    for i in range(0, repeat):
+        start = time()
+        result = f()
+        secs = time() - start
+        best = secs if (best is None) else min(best, secs)
+    return (best, result)
+
+
+# return the fields of a parsed record as a tuple, to compare records from the two parsers
+def record_fields(record):
+    if (record is None or isinstance(record, list)):
+        return record
+    return tuple([getattr(record, attr) for attr in record.__slots__])
+
+
+def main_classify(args):
+    work_dir = tempfile.mkdtemp(prefix='csefsck-bench-')
+    try:
+        path = work_dir + '/fs.img'
+        device = fsgen.create_device(path, args.blocks, 'image', args.block_size)
+        summary = fsgen.generate(device, args.blocks, args.depth, args.fanout, args.files, args.indirect_ratio, args.max_data_blocks,
+                                 leaked=args.leaked, seed=args.seed, block_size=args.block_size)
+        blocks = [(num, device.read(num)) for num in xrange(summary['root'], args.blocks)]
+        blocks = [(num, contents) for (num, contents) in blocks if (contents)]
+        device.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    (legacy_secs, legacy_kinds) = best_time(lambda: [legacy_identify_block(contents, num) for (num, contents) in blocks])
+    (fast_secs, fast_kinds) = best_time(lambda: [fsparse.identify_block(contents, num) for (num, contents) in blocks])
+    assert [(kind, record_fields(record)) for (kind, record) in legacy_kinds] == [(kind, record_fields(record)) for (kind, record) in fast_kinds]
+    counts = {}
+    for (kind, record) in fast_kinds:
+        counts[kind] = counts.get(kind, 0) + 1
+    print("%d blocks holding data: %s.\n" % (len(blocks), ', '.join(["%d %s" % (counts[kind], kind) for kind in sorted(counts)])))
+
+    inodes = [(num, contents) for ((num, contents), (kind, record)) in zip(blocks, fast_kinds) if (kind == 'file-inode')]
+    rows = [("identify every block", legacy_secs, fast_secs)]
+    for (name, legacy, fast, items) in [("parse file inodes", legacy_parse_file_inode, fsparse.parse_file_inode, inodes),
+                                        ("parse index blocks", lambda contents, num: legacy_parse_index_block(contents), lambda contents, num: fsparse.parse_index_block(contents), blocks)]:
+        (legacy_secs, legacy_records) = best_time(lambda: [legacy(contents, num) for (num, contents) in items])
+        (fast_secs, fast_records) = best_time(lambda: [fast(contents, num) for (num, contents) in items])
+        assert [record_fields(record) for record in legacy_records] == [record_fields(record) for record in fast_records]
+        rows.append((name, legacy_secs, fast_secs))
+    print("%-24s %10s %10s %8s" % ("", "legacy", "fast", "speedup"))
+    for (name, legacy_secs, fast_secs) in rows:
+        print("%-24s %9.3fs %9.3fs %7.2fx" % (name, legacy_secs, fast_secs, legacy_secs / max(fast_secs, 1e-6)))
+
+
+# return the git version of the working tree, e.g. 'bca96a6-dirty', or 'unknown' outside of a git checkout
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+'''
+Runs csefsck.check_filesystem() on the filesystem at path and returns (its --stats summary, peak RSS in KB).
+Runs in a child process, so the RSS is the checker's alone. The checker reads the geometry from the superblock; only the block size is passed in.
+'''
+def run_check(path, summary, jobs, timed_io):
+    stats = Stats()
+    (cache, block_map) = csefsck.check_filesystem(path, jobs, stats=stats, timed_io=timed_io, block_size=summary['block_size'])
+    return (stats.summary(cache), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main_check(args):
+    work_dir = tempfile.mkdtemp(prefix='csefsck-bench-')
+    try:
+        path = work_dir + '/fs' + ('.img' if args.layout == 'image' else '')
+        device = fsgen.create_device(path, args.blocks, args.layout, args.block_size)
+        start = time()
+        summary = fsgen.generate(device, args.blocks, args.depth, args.fanout, args.files, args.indirect_ratio, args.max_data_blocks,
+                                 args.future_times, args.bad_dots, args.bad_indirect, args.leaked, args.seed, args.block_size)
+        device.close()
+        print("Generated %d directories and %d files in %d blocks in %.2f s.\n" % (summary['dirs'], summary['files'], args.blocks, time() - start))
+
+        # a plain Process rather than a Pool worker, since a pool's (daemonic) workers can't start the checker's own pool for --jobs
+        results = Queue()
+        child = Process(target=run_quiet_check, args=(path, summary, args.jobs, args.timed_io, results))
+        child.start()
+        (stats, peak_rss) = results.get()
+        child.join()
+    finally:
+        shutil.rmtree(work_dir)
+
+    total = stats['total_secs']
+    for name in PHASES:
+        print("%-24s %9.3f s" % (name, stats['phases'][name]))
+    print("%-24s %9.3f s" % ("total", total))
+    for name in ['io_read', 'io_write', 'parse']:
+        if (name + '_secs' in stats):
+            print("%-24s %9.3f s (%d calls)" % (name, stats[name + '_secs'], stats[name + '_calls']))
+    print("%-24s %9.0f" % ("blocks/sec", args.blocks / total))
+    print("%-24s %9d (%d bytes)" % ("blocks read", stats['blocks_read'], stats['bytes_read']))
+    print("%-24s %9d (%d bytes)" % ("blocks written", stats['blocks_written'], stats['bytes_written']))
+    print("%-24s %9d KB" % ("peak RSS", peak_rss))
+
+    if (args.history):
+        result = {'version': git_version(), 'time': int(time()), 'blocks': args.blocks, 'block_size': args.block_size, 'layout': args.layout, 'dirs': summary['dirs'],
+                  'files': summary['files'], 'jobs': args.jobs, 'phases': stats['phases'], 'total': total,
+                  'blocks_per_sec': args.blocks / total, 'peak_rss_kb': peak_rss, 'stats': stats}
+        fh = open(args.history, 'a')
+        fh.write(json.dumps(result, sort_keys=True) + '\n')
+        fh.close()
+
+
+# run_check with its stdout thrown away (the check's messages aren't part of the benchmark), putting the result on results
+def run_quiet_check(path, summary, jobs, timed_io, results):
+    sys.stdout = open(os.devnull, 'w')
+    results.put(run_check(path, summary, jobs, timed_io))
+
+
+# run csefsck.py --check-only --stats on path under the interpreter python and return the stats it printed (its last line on stderr)
+def run_interpreter(python, path, block_size):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csefsck.py')
+    child = subprocess.Popen([python, script, path, '--check-only', '--stats', '--block-size', str(block_size)],
+                             stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+    (out, err) = child.communicate()
+    if (child.returncode != 0):
+        raise RuntimeError("%s exited with %d:\n%s" % (python, child.returncode, err.decode('utf-8', 'replace')))
+    return json.loads(err.decode('utf-8').strip().splitlines()[-1])
+
+
+def main_interpreters(args):
+    work_dir = tempfile.mkdtemp(prefix='csefsck-bench-')
+    try:
+        path = work_dir + '/fs.img'
+        device = fsgen.create_device(path, args.blocks, 'image', args.block_size)
+        summary = fsgen.generate(device, args.blocks, args.depth, args.fanout, args.files, seed=args.seed, block_size=args.block_size)
+        device.close()
+        print("Generated %d directories and %d files in %d blocks.\n" % (summary['dirs'], summary['files'], args.blocks))
+        results = [run_interpreter(python, path, args.block_size) for python in [args.python2, args.python3]]
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("%-24s %10s %10s %8s" % ("phase", "python2", "python3", "speedup"))
+    rows = [(name, [stats['phases'][name] for stats in results]) for name in PHASES if (name in results[0]['phases'])] # --check-only has no flush phase
+    rows.append(("total", [stats['total_secs'] for stats in results]))
+    for (name, (py2_secs, py3_secs)) in rows:
+        print("%-24s %9.3fs %9.3fs %7.2fx" % (name, py2_secs, py3_secs, py2_secs / max(py3_secs, 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for csefsck.py.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True # Python 3 doesn't require a subcommand otherwise
+    subparsers.add_parser('reconcile', help="free block reconciliation: list.count() scan vs block map")
+    check = subparsers.add_parser('check', help="time every phase of a full check of a generated filesystem")
+    check.add_argument('--layout', choices=['image', 'dir'], default='image')
+    check.add_argument('--blocks', type=int, default=10000)
+    check.add_argument('--block-size', type=int, default=csefsck.BLOCK_SIZE)
+    check.add_argument('--depth', type=int, default=3)
+    check.add_argument('--fanout', type=int, default=4)
+    check.add_argument('--files', type=int, default=1000)
+    check.add_argument('--indirect-ratio', type=float, default=0.25)
+    check.add_argument('--max-data-blocks', type=int, default=8)
+    check.add_argument('--future-times', type=int, default=0)
+    check.add_argument('--bad-dots', type=int, default=0)
+    check.add_argument('--bad-indirect', type=int, default=0)
+    check.add_argument('--leaked', type=int, default=0)
+    check.add_argument('--seed', type=int, default=0)
+    check.add_argument('--jobs', type=int, default=1)
+    check.add_argument('--timed-io', action='store_true', help="also time device reads/writes and block parsing (adds a little overhead)")
+    check.add_argument('--history', metavar='FILE', help="append the result as a JSON line to FILE")
+    classify = subparsers.add_parser('classify', help="identify and parse the blocks of a mixed filesystem: single-pass fast paths vs the old parsers")
+    classify.add_argument('--blocks', type=int, default=200000)
+    classify.add_argument('--block-size', type=int, default=1024)
+    classify.add_argument('--depth', type=int, default=3)
+    classify.add_argument('--fanout', type=int, default=10)
+    classify.add_argument('--files', type=int, default=20000)
+    classify.add_argument('--indirect-ratio', type=float, default=0.4)
+    classify.add_argument('--max-data-blocks', type=int, default=8)
+    classify.add_argument('--leaked', type=int, default=5000)
+    classify.add_argument('--seed', type=int, default=0)
+    interpreters = subparsers.add_parser('interpreters', help="time a --check-only run under Python 2 and Python 3")
+    interpreters.add_argument('--python2', default='python2', metavar='PATH')
+    interpreters.add_argument('--python3', default='python3', metavar='PATH')
+    interpreters.add_argument('--blocks', type=int, default=10000)
+    interpreters.add_argument('--block-size', type=int, default=csefsck.BLOCK_SIZE)
+    interpreters.add_argument('--depth', type=int, default=3)
+    interpreters.add_argument('--fanout', type=int, default=4)
+    interpreters.add_argument('--files', type=int, default=1000)
+    interpreters.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if (args.command == 'reconcile'):
+        main_reconcile(args)
+    elif (args.command == 'check'):
+        main_check(args)
+    elif (args.command == 'classify'):
+        main_classify(args)
+    elif (args.command == 'interpreters'):
+        main_interpreters(args)
+
+
+# run main() when benchmark.py is executed
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+'''
+
+    Block devices for csefsck.py
+
+    The checker reads and writes fusedata blocks through one of two devices with the same interface:
+
+        DirDevice    the original layout, one file per block: <dir>/fusedata.0 ... <dir>/fusedata.N
+        ImageDevice  a single image file holding every block back to back, BLOCK_SIZE bytes each, read through mmap
+                     (a block's contents end at the first NUL byte, so an all-NUL block is empty)
+
+    Both have:
+        read(num)            contents of block num as a string, or None if the block doesn't exist yet
+        write(num, contents) replace the contents of block num (IOError if the device was opened with readonly=True)
+        blocks_with_data(nums)
+                             the block numbers in nums whose blocks aren't empty, found without reading the blocks
+        prefetch(nums)       hint that blocks nums will be read soon (does nothing except on a ReadAhead)
+        sync()               wait until every block written so far is on disk (see fsjournal.py)
+        refresh()            forget what the device remembers about which blocks exist, after something else changed them (see fsdaemon.py)
+        close()              flush anything pending and release the device
+
+    A readonly device never opens anything for writing, so it can be used on read-only mounts and snapshots.
+    Block contents are always bytes, on Python 2 and 3.
+
+    ReadAhead wraps either device with a few reader threads that read prefetched blocks in the background,
+    so on slow (e.g. network backed) storage the reads of a directory's children overlap instead of waiting on each other.
+
+    Converting between the layouts
+    ----------------------------------------------------------------------------------------------------
+        python blockdev.py /fusedata fs.img      directory --> image
+        python blockdev.py fs.img /fusedata      image --> directory
+    ----------------------------------------------------------------------------------------------------
+
+'''
+
+from __future__ import print_function
+
+try:
+    from Queue import Queue
+except ImportError: # Python 3
+    from queue import Queue
+import argparse
+import mmap
+import os
+import threading
+
+from fsparse import BlockFormatError, parse_superblock
+
+DEFAULT_BLOCK_SIZE = 4096
+
+
+# one fusedata.X file per block under files_dir
+class DirDevice(object):
+    def __init__(self, files_dir, readonly=False):
+        self.files_dir = files_dir
+        self.readonly = readonly
+        self.names = None # names of the files in files_dir, listed the first time blocks_with_data is called
+        self.unsynced = set() # block numbers written since the last sync()
+
+    # return the path of the fusedata block number num
+    def path(self, num):
+        return "%s/fusedata.%d" % (self.files_dir, num)
+
+    def read(self, num):
+        try:
+            fh = open(self.path(num), 'rb')
+        except IOError:
+            # a free block that was never written doesn't have a file
+            return None
+        contents = fh.read()
+        fh.close()
+        return contents
+
+    def write(self, num, contents):
+        if (self.readonly):
+            raise IOError("%s was opened read-only" % self.files_dir)
+        fh = open(self.path(num), 'wb')
+        fh.write(contents)
+        fh.close()
+        self.unsynced.add(num)
+        if (self.names is not None):
+            self.names.add("fusedata.%d" % num)
+
+    # one listing of the directory tells which blocks have files at all; only those are stat()ed for their size
+    def blocks_with_data(self, nums):
+        if (self.names is None):
+            self.names = set(os.listdir(self.files_dir))
+        return [num for num in nums if ("fusedata.%d" % num in self.names and os.path.getsize(self.path(num)) > 0)]
+
+    # return the number of blocks on the device, i.e. one past the highest fusedata.X file
+    def num_blocks(self):
+        highest = -1
+        for name in os.listdir(self.files_dir):
+            if (name.startswith('fusedata.') and name[9:].isdigit()):
+                highest = max(highest, int(name[9:]))
+        return highest + 1
+
+    def prefetch(self, nums):
+        pass
+
+    # fsync every file written since the last sync, then the directory, which holds the names of the files that are new
+    def sync(self):
+        for num in sorted(self.unsynced):
+            fh = open(self.path(num), 'rb')
+            os.fsync(fh.fileno())
+            fh.close()
+        self.unsynced.clear()
+        directory = os.open(self.files_dir, os.O_RDONLY)
+        os.fsync(directory)
+        os.close(directory)
+
+    def refresh(self):
+        self.names = None
+
+    def close(self):
+        pass
+
+
+# every block in one file of num_blocks * block_size bytes, mapped into memory
+class ImageDevice(object):
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE, readonly=False):
+        self.path = path
+        self.block_size = block_size
+        self.readonly = readonly
+        if (readonly):
+            self.fh = open(path, 'rb')
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.fh = open(path, 'r+b')
+            self.mm = mmap.mmap(self.fh.fileno(), 0)
+
+    # create an empty (all NUL) image of num_blocks blocks at path and return it opened as an ImageDevice
+    @classmethod
+    def create(cls, path, num_blocks, block_size=DEFAULT_BLOCK_SIZE):
+        fh = open(path, 'wb')
+        fh.truncate(num_blocks * block_size)
+        fh.close()
+        return cls(path, block_size)
+
+    def num_blocks(self):
+        return len(self.mm) // self.block_size
+
+    def read(self, num):
+        if (num < 0 or num >= self.num_blocks()):
+            return None
+        start = num * self.block_size
+        end = self.mm.find(b'\0', start, start + self.block_size)
+        if (end < 0):
+            end = start + self.block_size
+        return self.mm[start:end]
+
+    def write(self, num, contents):
+        if (self.readonly):
+            raise IOError("%s was opened read-only" % self.path)
+        if (num < 0 or num >= self.num_blocks()):
+            raise IndexError("fusedata.%d is past the end of %s" % (num, self.path))
+        if (len(contents) > self.block_size):
+            raise ValueError("fusedata.%d holds %d bytes, more than the %d byte block size of %s" % (num, len(contents), self.block_size, self.path))
+        start = num * self.block_size
+        self.mm[start:start + len(contents)] = contents
+        self.mm[start + len(contents):start + self.block_size] = b'\0' * (self.block_size - len(contents))
+
+    # a block is empty if its first byte is NUL
+    def blocks_with_data(self, nums):
+        last = self.num_blocks()
+        size = self.block_size
+        return [num for num in nums if (num >= 0 and num < last and self.mm[num * size:num * size + 1] != b'\0')]
+
+    def prefetch(self, nums):
+        pass
+
+    def sync(self):
+        self.mm.flush()
+
+    # the map always shows what is in the image, so there is nothing to forget
+    def refresh(self):
+        pass
+
+    def close(self):
+        if (not self.readonly):
+            self.mm.flush()
+        self.mm.close()
+        self.fh.close()
+
+
+'''
+Wraps device so blocks can be read ahead of time by limit reader threads; at most limit reads are in flight at once.
+prefetch() queues block numbers for the readers, and read() of a prefetched block waits for its reader instead of reading it again.
+Everything else (writes included) goes straight to device; the readers are only busy while blocks are being prefetched,
+which the checker only does before it starts writing.
+'''
+class ReadAhead(object):
+    def __init__(self, device, limit):
+        self.device = device
+        self.requests = Queue()            # block numbers waiting for a reader, None to stop a reader
+        self.results = {}                  # block number --> (contents, None) or (None, the exception reading it raised)
+        self.wanted = set()                # block numbers prefetched but not read yet
+        self.arrived = threading.Condition()
+        self.readers = [threading.Thread(target=self.reader) for i in range(0, limit)]
+        for thread in self.readers:
+            thread.daemon = True
+            thread.start()
+
+    # everything but read, prefetch, and close is the wrapped device's
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    # a reader thread: read queued blocks until told to stop
+    def reader(self):
+        while (True):
+            num = self.requests.get()
+            if (num is None):
+                return
+            try:
+                result = (self.device.read(num), None)
+            except Exception as error:
+                result = (None, error)
+            self.arrived.acquire()
+            self.results[num] = result
+            self.arrived.notify_all()
+            self.arrived.release()
+
+    def prefetch(self, nums):
+        for num in nums:
+            if (num not in self.wanted):
+                self.wanted.add(num)
+                self.requests.put(num)
+
+    def read(self, num):
+        if (num not in self.wanted):
+            return self.device.read(num)
+        self.arrived.acquire()
+        while (num not in self.results):
+            self.arrived.wait()
+        (contents, error) = self.results.pop(num)
+        self.arrived.release()
+        self.wanted.discard(num)
+        if (error is not None):
+            raise error
+        return contents
+
+    def close(self):
+        for thread in self.readers:
+            self.requests.put(None)
+        for thread in self.readers:
+            thread.join()
+        self.device.close()
+
+
+# return the device for path: a DirDevice if path is a directory, otherwise an ImageDevice
+def open_device(path, block_size=DEFAULT_BLOCK_SIZE, readonly=False):
+    if (os.path.isdir(path)):
+        return DirDevice(path, readonly)
+    return ImageDevice(path, block_size, readonly)
+
+
+# copy every block of src to dst (either layout to the other), creating dst; returns the number of blocks copied
+def convert(src_path, dst_path, block_size=DEFAULT_BLOCK_SIZE, num_blocks=None):
+    src = open_device(src_path, block_size, readonly=True)
+    if (num_blocks is None):
+        num_blocks = src.num_blocks()
+        # free blocks in the directory layout may not have files yet, so size the image from the superblock's maxBlocks if it can be read
+        if (isinstance(src, DirDevice)):
+            try:
+                num_blocks = max(num_blocks, parse_superblock(src.read(0) or b'').max_blocks)
+            except BlockFormatError:
+                pass
+    if (isinstance(src, DirDevice)):
+        dst = ImageDevice.create(dst_path, num_blocks, block_size)
+    else:
+        if (not os.path.isdir(dst_path)):
+            os.makedirs(dst_path)
+        dst = DirDevice(dst_path)
+    for num in range(0, num_blocks):
+        contents = src.read(num)
+        if (contents is not None):
+            dst.write(num, contents)
+    src.close()
+    dst.close()
+    return num_blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a fusedata filesystem between the fusedata.N directory layout and a single image file.")
+    parser.add_argument('src', help="fusedata directory or image file to read")
+    parser.add_argument('dst', help="image file (if src is a directory) or directory (if src is an image) to create")
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help="bytes per block (default: %d)" % DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--blocks', type=int, default=None, help="number of blocks to copy (default: every block in src, or maxBlocks from a directory's superblock)")
+    args = parser.parse_args()
+
+    num_blocks = convert(args.src, args.dst, args.block_size, args.blocks)
+    print("Copied %d blocks from %s to %s.\n" % (num_blocks, args.src, args.dst))
+
+
+# run main() when blockdev.py is executed
+if __name__ == "__main__":
+    main()
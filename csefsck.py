@@ -23,6 +23,7 @@
             a) size < blocksize if indirect = 0 & size > 0
             b) size < (blocksize * length of location array) if indirect != 0
             c) size > (blocksize * (length of location array - 1)) if indirect != 0
+        8) Each file inode's linkcount matches the number of directory entries that link to it
     ------------------------------------------------------------------------------------------------
     
     
@@ -49,10 +50,17 @@
                 - size will thus be invalid
     -----------------------------------------------------------------------------------------------------------------------------------------------------------
     
+    
+    
+    Runs on Python 2.7 and Python 3 (3.5 or later). Block contents are bytes from the device to the parser and back, on either one.
+    
 '''
 
+from __future__ import print_function
+
 # ------------------------------------------------ CONSTANTS ------------------------------------------------------ #
 
+# the geometry constants (MAX_NUM_BLOCKS --> BLOCKS_IN_FREE) are only defaults; a check uses the Geometry read from the superblock (see load_geometry)
 MAX_NUM_BLOCKS   = 10000        # blocks on the filesyste
 MAX_FILE_SIZE    = 1638400      # maximum file size that a file inode will be able to handle with an indirect pointer
 BLOCK_SIZE       = 4096         # bytes that one block can hold
@@ -70,6 +78,7 @@ DIR_MODE         = 16877        # mode to represent a directory
 
 FILES_DIR	 = "/fusedata"         # directory where all the fusedata.X blocks will be stored
 LOG_FILE	 = "~/Desktop/log.txt" # filepath used to log program execution for testing
+LOST_FOUND	 = b"lost+found"       # name of the directory under root that unreachable directories and file inodes are reattached to
 
 # ------------------------------------------------ CONSTANTS ------------------------------------------------------ #
 
@@ -78,6 +87,36 @@ LOG_FILE	 = "~/Desktop/log.txt" # filepath used to log program execution for tes
 
 from time import time
 from sys import exit
+import json
+from multiprocessing import Pool
+from collections import deque, OrderedDict
+from array import array
+try:
+    from StringIO import StringIO
+except ImportError: # Python 3
+    from io import StringIO
+import argparse
+import cProfile
+import sys
+
+# NumPy is optional: without it FieldColumns compares its columns with a plain loop
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from fsparse import BlockFormatError, DirInode, parse_superblock, parse_dir, parse_file_inode, parse_index_block, identify_block
+from blockdev import open_device, ReadAhead
+from fsmanifest import Manifest
+from fscheckpoint import Checkpoint, CHECKPOINT_EVERY, fingerprint
+from fsshard import Scope, covers_filesystem, save_shard, load_shard
+from fsjournal import Journal
+from fsstats import Stats
+
+try:
+    xrange
+except NameError: # Python 3
+    xrange = range
 
 # -------------------------------------------- IMPORTED FUNCTIONS ------------------------------------------------- #
 
@@ -87,68 +126,224 @@ from sys import exit
 # --------------------------------------------- FILESYSTEM CHECKER ------------------------------------------------ #
 
 
+# --------------------------------------------- geometry functions ------------------------------------------------ #
+
+'''
+The layout of a filesystem: how many blocks it has and how big they are, and where the free block list and root directory are.
+The free list starts at free_start and needs one block per blocks_in_free blocks on the filesystem; root is the block right after it.
+blocks_in_free defaults to BLOCKS_IN_FREE per BLOCK_SIZE bytes of block, so a free list block has the same room per number at any block size.
+Without a free_end the free list is made just big enough, so Geometry() is the layout of the default constants (free list 1 --> 25, root 26).
+'''
+class Geometry(object):
+    def __init__(self, max_blocks=MAX_NUM_BLOCKS, block_size=BLOCK_SIZE, free_start=FREE_START, free_end=None, blocks_in_free=None):
+        if (blocks_in_free is None):
+            blocks_in_free = max(1, BLOCKS_IN_FREE * block_size // BLOCK_SIZE)
+        if (free_end is None):
+            free_end = free_start + (max_blocks + blocks_in_free - 1) // blocks_in_free - 1
+        self.max_blocks = max_blocks
+        self.block_size = block_size
+        self.free_start = free_start
+        self.free_end = free_end
+        self.root = free_end + 1
+        self.blocks_in_free = blocks_in_free
+
+    # return True if the layout makes sense: the free list comes after the superblock, can list every block, and root is on the filesystem
+    def valid(self):
+        free_list_blocks = self.free_end + 1 - self.free_start
+        return (self.free_start >= 1 and free_list_blocks * self.blocks_in_free >= self.max_blocks and self.root < self.max_blocks)
+
+# --------------------------------------------- geometry functions ------------------------------------------------ #
+
+
+
+# ------------------------------------------- block cache functions ----------------------------------------------- #
+
+'''
+Every fusedata block the checker reads or changes goes through a BlockCache on top of a block device (see blockdev.py).
+read() only reads a block from the device the first time it is needed; write() only marks a block dirty if its contents actually changed.
+Nothing is written to the device until flush() is called at the end of the run, so a clean filesystem is never written to,
+and with a journal every repair of the run is saved to it before the first block is written (see fsjournal.py).
+The cache also carries the filesystem's Geometry, so every check function that is handed the cache knows the layout it is checking.
+'''
+class BlockCache(object):
+    def __init__(self, device, geometry=None):
+        self.device = device
+        self.geometry = geometry or Geometry()
+        self.blocks = {}       # block number --> current contents of the block
+        self.dirty = set()     # block numbers whose contents differ from what is on disk
+        self.original = {}     # block number --> contents on disk, for every dirty block
+        self.missing = set()   # block numbers that don't exist on the device yet, e.g. a fusedata file that was never written (read as empty)
+        self.blocks_read = 0
+        self.bytes_read = 0
+        self.blocks_written = 0
+        self.bytes_written = 0
+
+    # return the contents of block number num, reading it from disk if it has not been read yet
+    def read(self, num):
+        if (num not in self.blocks):
+            contents = self.device.read(num)
+            if (contents is None):
+                # a free block that was never written doesn't exist yet; treat it as empty
+                self.missing.add(num)
+                contents = b''
+            self.blocks_read += 1
+            self.bytes_read += len(contents)
+            self.blocks[num] = contents
+        return self.blocks[num]
+
+    # replace the contents of block number num; the block is only marked dirty if the contents changed or its file doesn't exist
+    def write(self, num, contents):
+        if (self.read(num) != contents or num in self.missing):
+            if (num not in self.dirty):
+                self.original[num] = self.blocks[num]
+            self.blocks[num] = contents
+            self.dirty.add(num)
+
+    # return the block numbers in nums whose blocks hold data, asking the device about the ones that haven't been read (without reading them)
+    def blocks_with_data(self, nums):
+        unread = [num for num in nums if (num not in self.blocks)]
+        found = set(self.device.blocks_with_data(unread))
+        return [num for num in nums if (num in found or self.blocks.get(num))]
+
+    # let the device start reading blocks nums, which are about to be checked (see blockdev.ReadAhead)
+    def prefetch(self, nums):
+        self.device.prefetch([num for num in nums if (num not in self.blocks)])
+
+    # drop blocks nums, which something else changed on the device, so they are read again the next time they are needed
+    def forget(self, nums):
+        for num in nums:
+            self.blocks.pop(num, None)
+            self.missing.discard(num)
+        if (nums):
+            self.device.refresh()
+
+    # undo every repair that wasn't flushed: the dirty blocks go back to their contents on disk
+    def discard(self):
+        for num in self.dirty:
+            self.blocks[num] = self.original[num]
+        self.dirty.clear()
+        self.original.clear()
+
+    # write every dirty block back to the device in block order and count what was written; with a journal (an fsjournal.Journal), commit them to it first
+    # raises ValueError, before anything is journaled or written, if a block has grown past the block size
+    def flush(self, journal=None):
+        for num in sorted(self.dirty):
+            if (len(self.blocks[num]) > self.geometry.block_size):
+                raise ValueError("fusedata.%d would hold %d bytes, more than the %d byte block size, so no repairs were written" % (num, len(self.blocks[num]), self.geometry.block_size))
+        if (journal is not None and self.dirty):
+            journal.commit(self)
+        for num in sorted(self.dirty):
+            contents = self.blocks[num]
+            self.device.write(num, contents)
+            self.blocks_written += 1
+            self.bytes_written += len(contents)
+        if (journal is not None and self.dirty):
+            self.device.sync()
+            journal.mark('applied')
+        self.missing.difference_update(self.dirty)
+        self.dirty.clear()
+        self.original.clear()
+
+# ------------------------------------------- block cache functions ----------------------------------------------- #
+
+
+
 # ------------------------------------------- free block functions ------------------------------------------------ #
 
-# update the free block files to only include the free blocks
-def write_freeblock_list(free_blocks):
-    # freeblock_files will contain open file handles to the free block files
-    freeblock_files = {}
-    # temp_freeblock_list will be used to collect (FREE_END + 1 - FREE_START) lists containing free block numbers
-    temp_freeblock_list = []
-    # loop through each file appending to the freeblock_files dictionary
-    index = 0 # index will be the key values for the dictionary
-    for i in range(FREE_START, FREE_END + 1):
-        # open the free block file and empty its contents
-        block_path = "%s/fusedata.%d" % (FILES_DIR, i)
-        freeblock_files[index] = block_path
-        index += 1
-        temp_freeblock_list.append([])
-    
-    # loop over each int value that is a free block number
-    for k in free_blocks:
-        # index_val will correspond to the key for the temp_freeblock_list entry
-        # ex. k = 44, BLOCKS_IN_FREE = 400, index_val = 0; temp_freeblock_list[index_val] is a file handle for the first file storing a free block list
-        index_val = k / BLOCKS_IN_FREE
-        temp_freeblock_list[index_val].append(str(k))
-        
-        # open the file corresponding to a free block with 'w' which will clear its contents, then close it
-        path = "%s/fusedata.%d" % (FILES_DIR, k)
-        fh = open(path, 'w')
-        fh.close()
-    
-    # temp_freeblock_list now contains lists correlating to freeblock files along with all the free block numbers
-    for l in range(0, len(temp_freeblock_list)):
-        # join the free blocks for an index into a str
-        freeblocks_str = ', '.join(temp_freeblock_list[l])
+'''
+Rewrites the free block list from the block map, one free list block at a time: block free_start + i lists the free blocks among
+i * blocks_in_free --> (i + 1) * blocks_in_free - 1, so each one is built from its own slice of the map and no list of every free block is kept.
+A free block is only cleared if it still holds data, which the device can tell without reading it (see BlockCache.blocks_with_data);
+those few are cleared after the free list is written, and flush() writes them back together in block order.
+'''
+def write_freeblock_list(cache, block_map):
+    geometry = cache.geometry
+    owners = block_map.owners
+    holding_data = []
+    for i in range(0, geometry.free_end + 1 - geometry.free_start):
+        first = max(i * geometry.blocks_in_free, geometry.root + 1)
+        last = min((i + 1) * geometry.blocks_in_free, geometry.max_blocks)
+        free_blocks = [k for k in xrange(first, last) if (owners[k] == 0)]
+        holding_data.extend(cache.blocks_with_data(free_blocks))
         # write the free block numbers joined by commas and a space to the corresponding free block file
-        fh = open(freeblock_files[l], 'w')
-        fh.write(freeblocks_str)
-        fh.close()
+        cache.write(geometry.free_start + i, b', '.join([b'%d' % k for k in free_blocks]))
+    for k in holding_data:
+        cache.write(k, b'')
         
         
-# return a list containing all possible free blocks that could exist, i.e. ROOT + 1 --> MAX_NUM_BLOCKS    
-def get_possible_freeblocks():
-    # listy will contain all integers that could be free blocks
-    listy = []
-    # loop through the possible range of ints
-    for i in range(ROOT + 1, MAX_NUM_BLOCKS):
-        listy.append(i)
-    return listy
+'''
+Who owns every block on the filesystem: owners[num] is the block number of the directory or file inode that points to block num, or 0 if nothing does
+(block 0 is the superblock, which never owns anything). A directory owns its sub-directories and file inodes, a file inode its location and data blocks.
+A block claimed by a second owner is cross-linked; cross_links keeps the other owners, so owners_of() can name everyone pointing at a block.
+One claim is an array store, so building the map over the whole tree is linear in the number of pointers.
+'''
+class BlockMap(object):
+    def __init__(self, geometry):
+        self.owners = array('i', [0]) * geometry.max_blocks
+        self.cross_links = {} # block number --> owners after the first, in the order they claimed it
+
+    # mark block number num as owned by owner; returns the block's owner before the claim (0 if it was unclaimed)
+    def claim(self, num, owner):
+        previous = self.owners[num]
+        if (previous == 0):
+            self.owners[num] = owner
+        elif (previous != owner):
+            self.cross_links.setdefault(num, []).append(owner)
+        return previous
+
+    # return True if block number num has already been claimed
+    def claimed(self, num):
+        return (self.owners[num] != 0)
+
+    # return every owner of block number num, first claim first ([] if it's free)
+    def owners_of(self, num):
+        if (self.owners[num] == 0):
+            return []
+        return [self.owners[num]] + self.cross_links.get(num, [])
+
+
+# return True if num can be a pointer to a directory, inode, or data block: past the superblock, free list, and root, and on the filesystem
+def valid_pointer(geometry, num):
+    return (num > geometry.root and num < geometry.max_blocks)
+
+
+# print why pointer num in fusedata.owner isn't a valid pointer (see valid_pointer)
+def report_bad_pointer(geometry, owner, num):
+    if (num >= geometry.max_blocks or num < 0):
+        print("Error: fusedata.%d points to fusedata.%d, past the end of the %d block filesystem. The pointer was ignored.\n" % (owner, num, geometry.max_blocks))
+    else:
+        print("Error: fusedata.%d points to fusedata.%d, which is reserved for the %s. The pointer was ignored.\n" % (owner, num, reserved_kind(geometry, num)))
+
+
+# return what reserved block number num (0 --> root) holds
+def reserved_kind(geometry, num):
+    if (num == 0):
+        return 'superblock'
+    if (num < geometry.free_start or num > geometry.free_end):
+        return 'root directory'
+    return 'free block list'
+
+
+# walk the block map once and return (free_blocks, cross_linked_blocks) for every block that could be free, i.e. root + 1 --> max_blocks
+def reconcile_blocks(block_map, geometry):
+    owners = block_map.owners
+    free_blocks = [i for i in xrange(geometry.root + 1, geometry.max_blocks) if (owners[i] == 0)]
+    return (free_blocks, sorted(block_map.cross_links))
 
 
 # update the free block list, removing any blocks that are denoted as in use by the filesystem starting from root
-def update_freeblock_list(used_blocks):
-    all_blocks = get_possible_freeblocks()
-    used_blocks.sort()
-    free_blocks = []
-    
-    # loop through all possible free block values
-    for i in all_blocks:
-        # if a free block value is not in the used_blocks list, add it to the free_blocks list
-        if (used_blocks.count(i) == 0):
-            free_blocks.append(i)
-    
-    write_freeblock_list(free_blocks)
+def update_freeblock_list(cache, block_map):
+    cache.prefetch(range(cache.geometry.free_start, cache.geometry.free_end + 1))
+    report_cross_links(block_map)
+    write_freeblock_list(cache, block_map)
+
+
+# print every block in block_map that more than one directory/inode claims
+def report_cross_links(block_map):
+    # a block that two inodes both point to can't be fixed automatically since we don't know which one really owns the data
+    for i in sorted(block_map.cross_links):
+        owners = block_map.owners_of(i)
+        print("Error: fusedata.%d is claimed by %d directories/inodes (%s). It is double-allocated.\n" % (i, len(owners), ', '.join(["fusedata.%d" % k for k in owners])))
 
 # ------------------------------------------- free block functions ------------------------------------------------ #
 
@@ -156,103 +351,98 @@ def update_freeblock_list(used_blocks):
 # ------------------------------------------- superblock functions ------------------------------------------------ #
 
 # Returns a boolean based on the check if the device ID that is stored in the superblock, aka fusedata.0, is the correct ID
-def check_devId():
-    # read the contents of the superblock file into the variable: contents
-    superblock_path = FILES_DIR + "/fusedata.0"
-    superblock = open(superblock_path, 'r+')
-    contents = superblock.read()
-    contents = contents.strip() # strip any whitespace
-    # break contents into a list separated by commas
-    file_list = contents.split(',')
-    # break the devId part into a 2 component list with the string devId and devId number
-    test_devId_list = file_list[2].split(':')
-    # put the stringified devId number into test_devId
-    test_devId = test_devId_list[1]
-    test_devId_str = test_devId.strip() # strip any whitespace from the devId number
-    test_devId_num = int(test_devId_str) # convert it to a variable of type int
-
-    if (DEV_ID != test_devId_num):
-        print "Device ID did not match the expected value... awkward\n"
+def check_devId(cache):
+    try:
+        superblock = parse_superblock(cache.read(0))
+    except BlockFormatError:
+        print("The superblock in fusedata.0 has been corrupted and the device ID can't be read.\n")
         exit(1)
 
-    # write the contents back to the file
-    superblock.seek(0)
-    superblock.truncate()
-    superblock.write(contents)
-    superblock.close()
+    if (DEV_ID != superblock.dev_id):
+        print("Device ID did not match the expected value... awkward\n")
+        exit(1)
 
 
 # check and possibly update the superblock's creationTime
-def check_superblock_time(t, file_list):
-    # break the creationTime part into a 2 component list
-    test_ctime_list = file_list[0].split(':')
-    # put the stringified creationTime number into test_ctime
-    test_ctime = test_ctime_list[1]
-    test_ctime_str = test_ctime.strip() # strip any whitespace from ctime number
-    test_ctime_num = int(test_ctime_str) # convert it to a variable of type int
-    
-    if (t < test_ctime_num):
-        print "Time in the superblock was a future value and is now the current time\n"
-        file_list[0] = file_list[0].replace(test_ctime_str, str(t))
+def check_superblock_time(t, superblock):
+    if (t < superblock.creation_time):
+        print("Time in the superblock was a future value and is now the current time\n")
+        superblock.creation_time = t
         # assme for simplicity that file size of superblock does not pass BLOCK_SIZE
 
 
 # check and possibly update the superblock's fusedata block info
-def check_superblock_block_data(t, file_list):
-    # break the block data info part into 4 2 component lists
-    test_data_list = []
-    # append freeStart, freeEnd, root, and maxBlocks data to the list, in that indexed order
-    for i in range(3, 7):
-        test_data_list.append(file_list[i].split(':'))
-    # for each data value, test for its correctness in reference to global consts
-    for j in range(0, 4):
-        # put the stringified int value to test into test_data
-        test_data = test_data_list[j][1]
-        # strip any whitespace, and if it is index 4 (maxBlocks), strip the ending '}' char
-        test_data_str = test_data.strip()
-        if (j == 3):
-            test_data_str = test_data_str.rstrip('}')
-        test_data_num = int(test_data_str) # convert it to a variable of type int
-        
-        # determine which case is being tested and update the appropriate value if needed
-        if (j == 0): # freeStart
-            if (test_data_num != FREE_START):
-                print "freeStart in the superblock was incorrect and has been corrected\n"
-                file_list[3] = file_list[3].replace(test_data_str, str(FREE_START))
-        elif (j == 1): # freeEnd
-            if (test_data_num != FREE_END):
-                print "freeEnd in the superblock was incorrect and has been corrected\n"                
-                file_list[4] = file_list[4].replace(test_data_str, str(FREE_END))
-        elif (j == 2): # root
-            if (test_data_num != ROOT):
-                print "root in the superblock was incorrect and has been corrected\n"
-                file_list[5] = file_list[5].replace(test_data_str, str(ROOT))
-        else: # maxBlocks
-            if (test_data_num != MAX_NUM_BLOCKS):
-                print "maxBlocks in the superblock was incorrect and has been corrected\n"
-                file_list[6] = file_list[6].replace(test_data_str, str(MAX_NUM_BLOCKS))
+def check_superblock_block_data(t, superblock, geometry):
+    # for each data value, test for its correctness in reference to the geometry being checked and update it if needed
+    for (attr, name) in [('free_start', 'freeStart'), ('free_end', 'freeEnd'), ('root', 'root'), ('max_blocks', 'maxBlocks')]:
+        expected = getattr(geometry, attr)
+        if (getattr(superblock, attr) != expected):
+            print("%s in the superblock was incorrect and has been corrected\n" % name)
+            setattr(superblock, attr, expected)
     
     
+# return 2 if block num parses as a directory whose '.' and '..' both point to itself (as root's do), 1 if it parses as any directory, else 0
+def root_score(cache, num):
+    try:
+        entries = parse_dir(cache.read(num), num).entries
+    except BlockFormatError:
+        return 0
+    dots = dict([(name, block_num) for (entry_type, name, block_num) in entries if (name in (b'.', b'..'))])
+    return 2 if (dots.get(b'.') == num and dots.get(b'..') == num) else 1
+
+
+'''
+Returns the Geometry of the filesystem in cache, from its superblock. Any of max_blocks, block_size, and free_end that aren't None override the superblock.
+maxBlocks is trusted as long as root fits below it; otherwise the device's size is used (at least MAX_NUM_BLOCKS, since a fusedata directory only has files for blocks that were written).
+freeStart, freeEnd, and root must agree (the free list runs freeStart --> freeEnd and root is the block after it). When exactly one of them doesn't fit the layout
+the others give, the others are trusted and that one is reset: root, when freeEnd and root disagree but the free list is sound; freeEnd, when root is right after
+a different free list; freeStart (back to FREE_START), when freeEnd and root agree but the free list from freeStart can't list every block.
+Only if none of those fits is maxBlocks cut down to what the free list can hold, and only if it came from the superblock and no block exists past that.
+Of the layouts that are valid, the first whose root looks like root (see root_score) is taken; if there is none the default layout for maxBlocks is used.
+A max_blocks that no layout fits (root would be past the end, or the free list can't list that many blocks) is replaced by maxBlocks from the superblock.
+check_superblock then corrects the superblock to match.
+'''
+def load_geometry(cache, max_blocks=None, block_size=BLOCK_SIZE, free_end=None):
+    superblock = parse_superblock(cache.read(0))
+    from_superblock = (max_blocks is None)
+    if (from_superblock):
+        max_blocks = superblock.max_blocks
+        if (max_blocks <= superblock.root):
+            max_blocks = max(cache.device.num_blocks(), MAX_NUM_BLOCKS)
+            print("maxBlocks in the superblock is too small for the filesystem, so %d blocks are checked\n" % max_blocks)
+    if (free_end is not None):
+        return Geometry(max_blocks, block_size, FREE_START, free_end)
+
+    (free_start, root) = (max(superblock.free_start, FREE_START), superblock.root)
+    if (root == superblock.free_end + 1):
+        candidates = [Geometry(max_blocks, block_size, free_start, superblock.free_end), Geometry(max_blocks, block_size, FREE_START, superblock.free_end)]
+        capacity = (superblock.free_end + 1 - free_start) * candidates[0].blocks_in_free
+        if (from_superblock and root < capacity and cache.device.num_blocks() <= capacity):
+            candidates.append(Geometry(capacity, block_size, free_start, superblock.free_end))
+    else:
+        candidates = [Geometry(max_blocks, block_size, free_start, superblock.free_end), Geometry(max_blocks, block_size, free_start, root - 1)]
+    candidates = [geometry for geometry in candidates if (geometry.valid())]
+    if (not from_superblock and not candidates):
+        print("--blocks %d doesn't fit the free block list and root in the superblock, so maxBlocks from the superblock (%d) is used instead\n" % (max_blocks, superblock.max_blocks))
+        return load_geometry(cache, None, block_size)
+    for score in [2, 1]:
+        for geometry in candidates:
+            if (root_score(cache, geometry.root) == score):
+                if (geometry.max_blocks != max_blocks):
+                    print("The free block list in the superblock can only hold %d blocks, so %d blocks are checked\n" % (geometry.max_blocks, geometry.max_blocks))
+                return geometry
+    return Geometry(max_blocks, block_size)
+
+
 # checks and updates (if needed) the superblock's creationTime, freeStart, freeEnd, root, and maxBlocks entries
-def check_superblock(t):
-    # read the contents of the superblock file into the variable: contents
-    superblock_path = FILES_DIR + "/fusedata.0"
-    superblock = open(superblock_path, 'r+')
-    contents = superblock.read()
-    contents = contents.strip() # strip any whitespace
-    # break contents into a list separated by commas
-    file_list = contents.split(',')
+def check_superblock(cache, t):
+    superblock = parse_superblock(cache.read(0))
     
-    # check the superblock's data (file_list is a container and can be used by reference in functions)
-    check_superblock_time(t, file_list)
-    check_superblock_block_data(t, file_list)
-    # get the superblock content back into string format
-    contents = ','.join(file_list)
+    # check the superblock's data (superblock is a record and can be updated by reference in functions)
+    check_superblock_time(t, superblock)
+    check_superblock_block_data(t, superblock, cache.geometry)
 
-    superblock.seek(0)
-    superblock.truncate()
-    superblock.write(contents)
-    superblock.close()
+    cache.write(0, superblock.serialize())
 
 # ------------------------------------------- superblock functions ------------------------------------------------ #
 
@@ -260,113 +450,24 @@ def check_superblock(t):
 # -------------------------------------- timing and permission functions ------------------------------------------ #
 
 '''
-Checks the atime, ctime, mtime for the current entry in the file system, and if any are greater than the passed in time 't', return False.
-Recursively checks all entries in filename_to_inode_dict if this entry is a directory.
-The recursive calls will return booleans based on each respective entry's atime, ctime, mtime comparison with time 't'.
-entry_type will either be 'd' or 'f' corresponding to 'directory' and 'file inode', respectively.
+Checks the atime, ctime, mtime for the current entry in the file system, and if any are greater than the passed in time 't', they are set to 't'.
+record is the entry's DirInode or FileInode, so the directory/inode is only read and parsed once by check_dir/check_file_inode.
+Returns True if any of the times were changed.
 '''
-def check_entry_times(t, entry_type, num):
-    # read the contents of the fusedata block into the variable: contents
-    block_path = FILES_DIR + "/fusedata." + str(num)
-    block = open(block_path, 'r+')
-    contents = block.read()
-    contents = contents.strip() # strip any whitespace
-    
-    # break contents into a list separated by commas
-    file_list = contents.split(',')
-    
-    if (entry_type == 'f'):
-        if (contents.count('{') != 1 and contents.count('}') != 1):
-            print "Corrupt data in fusedata.%d: it does not contain inode data. check_entry_times cannot proceed.\n" % num
-            return
-        file_list_atime_index = 5
-        file_list_ctime_index = 6
-        file_list_mtime_index = 7
-    else:
-        if (contents.count('{') != 2 and contents.count('}') != 2):
-            print "Corrupt data in fusedata.%d: it does not contain directory data. check_entry_times cannot proceed.\n" % num
-            return
-        file_list_atime_index = 4
-        file_list_ctime_index = 5
-        file_list_mtime_index = 6
-
-    # break the times into 2 component lists
-    test_atime_list = file_list[file_list_atime_index].split(':')
-    test_ctime_list = file_list[file_list_ctime_index].split(':')
-    test_mtime_list = file_list[file_list_mtime_index].split(':')
-    
-    # atime
-    test_atime = test_atime_list[1]
-    test_atime_str = test_atime.strip() # strip any whitespace from atime number
-    test_atime_num = int(test_atime_str) # convert it to a variable of type int
-    # ctime
-    test_ctime = test_ctime_list[1]
-    test_ctime_str = test_ctime.strip() # strip any whitespace from ctime number
-    test_ctime_num = int(test_ctime_str) # convert it to a variable of type int
-    # mtime
-    test_mtime = test_mtime_list[1]
-    test_mtime_str = test_mtime.strip() # strip any whitespace from mtime number
-    test_mtime_num = int(test_mtime_str) # convert it to a variable of type int
-    
+def check_entry_times(t, record, num):
     changed = False
-    # update atime if it is a value in the future
-    if (t < test_atime_num):
-        changed = True
-        print "atime in fusedata.%d was a future value and is now the current time\n" % num
-        file_list[file_list_atime_index] = file_list[file_list_atime_index].replace(test_atime_str, str(t))
-        # contents = ','.join(file_list)
-        # assme for simplicity that file size of superblock does not pass BLOCK_SIZE
-
-    # update ctime if it is a value in the future                
-    if (t < test_ctime_num):
-        changed = True
-        print "ctime in fusedata.%d was a future value and is now the current time\n" % num
-        file_list[file_list_ctime_index] = file_list[file_list_atime_index].replace(test_ctime_str, str(t))
-        # contents = ','.join(file_list)
-        # assme for simplicity that file size of superblock does not pass BLOCK_SIZE
-
-    # update mtime if it is a value in the future
-    if (t < test_mtime_num):
-        changed = True
-        print "mtime in fusedata.%d was a future value and is now the current time\n" % num
-        file_list[file_list_mtime_index] = file_list[file_list_mtime_index].replace(test_mtime_str, str(t))
-        # contents = ','.join(file_list)
-        # assme for simplicity that file size of superblock does not pass BLOCK_SIZE
-    
-    # if we changed any of the time values, update the contents variable
-    if (changed):
-        contents = ','.join(file_list)
+    # check atime, ctime, and mtime in that order, updating any value that is in the future
+    for name in ('atime', 'ctime', 'mtime'):
+        if (t < getattr(record, name)):
+            changed = True
+            print("%s in fusedata.%d was a future value and is now the current time\n" % (name, num))
+            setattr(record, name, t)
     
-    block.seek(0)
-    block.truncate()
-    block.write(contents)
-    block.close()
-    
-    # if this fusedata block is a directory, recursively call this function on all directory entries (except '.' and '..')   
-    if (entry_type == 'd'):
-        # split the file contents by '{' to separate some of the filename to inode dict
-        file_list = contents.split('{')
-        # split again by '}' to get the inode_list as the first index of the created list
-        inode_list = file_list[2].split('}')
-        # now the inode_list is actually a list with each directory entry
-        inode_list = inode_list[0].split(',')
-        for entry in inode_list:
-            entry = entry.strip()
-            # inode_content is a list: 0 --> type; 1 --> name; 2 --> block number
-            inode_content = entry.split(':')
-            if (inode_content[1] != '.' and inode_content[1] != '..'):
-                # recursive call to check the directory's next entry's time data
-                check_entry_times(t, inode_content[0], int(inode_content[2]))
-        
-        
-# check_times is called from main and simply gets the current time and calls check_entry_times
-def check_times():
-    time_since_epoch = int(time())
-    check_entry_times(time_since_epoch, 'd', ROOT)
+    return changed
 
 
-# update directory/inode uid, gid, and mode if the values are incorrect; file_list is the block data, entry_type is a char representing a directory 'd' or an inode 'f'
-def check_permissions(file_list, entry_type):
+# update directory/inode uid, gid, and mode if the values are incorrect; record is the parsed block, entry_type is a char representing a directory 'd' or an inode 'f'
+def check_permissions(record, entry_type):
     if (entry_type == 'd'):
         uid_val = DIR_UID
         gid_val = DIR_GID
@@ -376,33 +477,111 @@ def check_permissions(file_list, entry_type):
         gid_val = GID
         mode_val = INODE_MODE
         
-    # permis_list index:entry_data --> 0:size, 1:uid, 2:gid, 3:mode, 4:atime, etc...
-    if (entry_type == 'd'):
-        permis_list = file_list[1].split(',')
-    else: # entry_type == 'f'
-        permis_list = file_list # file_list already has the correct format for permis_list for a file inode
-    for i in range(1, 4): # check and update (if needed) the uid, gid, and mode
-        data = permis_list[i].split(':') # get the number for the uid/gid/mode
-        data_str = data[1].strip() # strip any whitespace
-        data_num = int(data_str) # get the data as an int
-        
-        # update the uid, gid, mode values if necessary replacing the old value that used to be there
-        if (i == 1): # uid
-            if (data_num != uid_val):
-                print "A file's UID value was invalid, so it was corrected to the appropriate value.\n"
-                permis_list[i] = permis_list[i].replace(data_str, str(uid_val))
-        elif (i == 2): # gid
-            if (data_num != gid_val):
-                print "A file's GID value was invalid, so it was corrected to the appropriate value.\n"
-                permis_list[i] = permis_list[i].replace(data_str, str(gid_val))
-        else: # mode
-            if (data_num != mode_val):
-                print "A file's mode value was invalid, so it was corrected to the appropriate value.\n"                
-                permis_list[i] = permis_list[i].replace(data_str, str(mode_val))
-    
-    # rejoin the possibly newly updated content back into the passed in file_list list
-    if (entry_type == 'd'):
-        file_list[1] = ','.join(permis_list)
+    # update the uid, gid, mode values if necessary
+    if (record.uid != uid_val):
+        print("A file's UID value was invalid, so it was corrected to the appropriate value.\n")
+        record.uid = uid_val
+    if (record.gid != gid_val):
+        print("A file's GID value was invalid, so it was corrected to the appropriate value.\n")
+        record.gid = gid_val
+    if (record.mode != mode_val):
+        print("A file's mode value was invalid, so it was corrected to the appropriate value.\n")
+        record.mode = mode_val
+
+
+# typecode of the time and id columns: 64 bits, since times can be past 2038 ('q' doesn't exist on Python 2, where 'l' is 64 bits on 64 bit Linux)
+try:
+    FIELD_TYPECODE = array('q').typecode
+except ValueError:
+    FIELD_TYPECODE = 'l'
+
+
+'''
+The atime, ctime, mtime, uid, gid, and mode of every directory and file inode checked, one array per field (a column), plus each one's block number and kind.
+check_dir and check_file_inode only add their record's fields; check_fields then compares whole columns with the current time and the expected ids at once
+(with NumPy if it's installed, else in one loop over the rows), and only the directories/inodes that fail are parsed again and fixed.
+The columns also give the distribution of the times over the whole filesystem (see summary).
+'''
+class FieldColumns(object):
+    NAMES = ('atime', 'ctime', 'mtime', 'uid', 'gid', 'mode')
+    COLUMNS = ('nums', 'is_dir') + NAMES
+
+    def __init__(self):
+        self.nums = array('i')   # block number of each row
+        self.is_dir = array('b') # 1 for a directory, 0 for a file inode
+        for name in self.NAMES:
+            setattr(self, name, array(FIELD_TYPECODE))
+
+    def __len__(self):
+        return len(self.nums)
+
+    # add a row for record, the DirInode (entry_type 'd') or FileInode ('f') in block number num
+    def add(self, num, entry_type, record):
+        self.nums.append(num)
+        self.is_dir.append(entry_type == 'd')
+        for name in self.NAMES:
+            getattr(self, name).append(getattr(record, name))
+
+    # add every row of other (the columns a --jobs worker collected)
+    def extend(self, other):
+        for name in self.COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+
+    # return the column called name as a NumPy array sharing its memory
+    def column(self, name):
+        values = getattr(self, name)
+        return numpy.frombuffer(values, dtype=values.typecode) if (len(values) > 0) else numpy.zeros(0, dtype=values.typecode)
+
+    # return (rows with a time after t, rows whose uid, gid, or mode isn't the one their kind should have), in the order the rows were added
+    def problems(self, t):
+        if (numpy is not None):
+            is_dir = self.column('is_dir') != 0
+            future = (self.column('atime') > t) | (self.column('ctime') > t) | (self.column('mtime') > t)
+            wrong_ids = ((self.column('uid') != numpy.where(is_dir, DIR_UID, UID)) | (self.column('gid') != numpy.where(is_dir, DIR_GID, GID))
+                         | (self.column('mode') != numpy.where(is_dir, DIR_MODE, INODE_MODE)))
+            return (numpy.flatnonzero(future).tolist(), numpy.flatnonzero(wrong_ids).tolist())
+        expected = [(UID, GID, INODE_MODE), (DIR_UID, DIR_GID, DIR_MODE)]
+        future = []
+        wrong_ids = []
+        for (i, row) in enumerate(zip(self.is_dir, self.atime, self.ctime, self.mtime, self.uid, self.gid, self.mode)):
+            if (row[1] > t or row[2] > t or row[3] > t):
+                future.append(i)
+            if (row[4:] != expected[row[0]]):
+                wrong_ids.append(i)
+        return (future, wrong_ids)
+
+    # return a dict with the number of directories and file inodes, the oldest and newest of each time, and how many rows have future times or wrong ids
+    def summary(self, t):
+        directories = sum(self.is_dir)
+        result = {'directories': directories, 'file_inodes': len(self) - directories}
+        for name in ('atime', 'ctime', 'mtime'):
+            values = getattr(self, name)
+            if (len(values) > 0):
+                if (numpy is not None):
+                    values = self.column(name)
+                    (result['oldest_' + name], result['newest_' + name]) = (int(values.min()), int(values.max()))
+                else:
+                    (result['oldest_' + name], result['newest_' + name]) = (min(values), max(values))
+        (future, wrong_ids) = self.problems(t)
+        (result['future_times'], result['wrong_ids']) = (len(future), len(wrong_ids))
+        return result
+
+
+'''
+Fixes the times and ids of every directory and file inode in fields (see FieldColumns) that are in the future or wrong.
+Only those are read from the cache and parsed again; check_permissions and check_entry_times fix them and print what they fixed.
+'''
+def check_fields(cache, t, fields):
+    (future, wrong_ids) = fields.problems(t)
+    for i in sorted(set(future).union(wrong_ids)):
+        my_num = fields.nums[i]
+        if (fields.is_dir[i]):
+            (record, entry_type) = (parse_dir(cache.read(my_num), my_num), 'd')
+        else:
+            (record, entry_type) = (parse_file_inode(cache.read(my_num), my_num), 'f')
+        check_permissions(record, entry_type)
+        check_entry_times(t, record, my_num)
+        cache.write(my_num, record.serialize())
 
 # -------------------------------------- timing and permission functions ------------------------------------------ #
 
@@ -410,216 +589,924 @@ def check_permissions(file_list, entry_type):
 # ------------------------------------------- file inode function ------------------------------------------------- #
 
 # checks if the linkcount is correct, if indirect is set correctly, and if the size is a value that makes sense with respect to blocksize and indirect
-def check_file_inode(my_num, blocks_in_use):
-    # read the contents of the fusedata block into the variable: contents
-    block_path = FILES_DIR + "/fusedata." + str(my_num)
-    block = open(block_path, 'r+')
-    contents = block.read()
+# links is the number of directory entries that point to the inode (its real hard link count), or None if it isn't known
+# with fields (a FieldColumns) the times and ids are added to it for check_fields instead of being checked here
+# returns the list of blocks the inode points to (its location and any data blocks listed there) so the caller can mark them as in use ([] if location isn't a valid pointer), or None if the inode is corrupt
+def check_file_inode(cache, t, my_num, links=None, fields=None):
     # print an error message and stop checking the inode if the data in the block does not match the format expected
-    if (contents.count('{') != 1 and contents.count('}') != 1):
-        print "Inode metadata in fusedata.%d has been corrupted and does match the expected format. Exitting check of this inode.\n" % my_num
-        return -1
-    contents = contents.strip() # strip any whitespace
-    file_list = contents.split(',')
-    check_permissions(file_list, 'f')
+    try:
+        inode = parse_file_inode(cache.read(my_num), my_num)
+    except BlockFormatError:
+        print("Inode metadata in fusedata.%d has been corrupted and does match the expected format. Exitting check of this inode.\n" % my_num)
+        return None
+    if (fields is None):
+        check_permissions(inode, 'f')
+        check_entry_times(t, inode, my_num)
+    else:
+        fields.add(my_num, 'f', inode)
     
-    # ---------------------- string parsing to get size, linkcount, indirect, and location ------------------------ #
-    # get the size
-    size_data = file_list[0]
-    size_list = size_data.split(':')
-    size_str = size_list[1].strip()
-    size_num = int(size_str)    
-    # get the linkcount
-    linkcount_data = file_list[4]
-    linkcount_list = linkcount_data.split(':')
-    linkcount_str = linkcount_list[1].strip()
-    linkcount_num = int(linkcount_str)
-    # if the linkcount is somehow less than 1, set it to one since we know something points to this inode since this function was called
-    if (linkcount_num < 1):
-        file_list[4] = file_list[4].replace(linkcount_str, '1')
-    # get the indirect and location value
-    indirect_location_data = file_list[8]
-    # file_list[8] is formatted as such: " indirect:num location:block_num}"
-    indirect_location_list = indirect_location_data.split(' ')
-    # indirect_location_list is formatted as such" ['', 'indirect:num', 'location:block_num}']
-    # get the indirect
-    indirect_list = indirect_location_list[1].split(':')
-    indirect_str = indirect_list[1].strip()
-    # get the location
-    location_data = indirect_location_list[2]
-    location_data = location_data.rstrip('}')
-    location_list = location_data.split(':')
-    location_str = location_list[1].strip()
-    location_num = int(location_str)
-    # ---------------------- string parsing to get size, linkcount, indirect, and location ------------------------ #
+    # the linkcount must be the number of entries linking to the inode; if that isn't known it must at least be 1, since something points to this inode since this function was called
+    if (links is not None and inode.linkcount != links):
+        print("linkcount in fusedata.%d was %d but %d directory entries link to it, so it has been corrected\n" % (my_num, inode.linkcount, links))
+        inode.linkcount = links
+    elif (inode.linkcount < 1):
+        inode.linkcount = 1
     
-    blocks_in_use.append(location_num)
+    # location has to be a block of the data area; the superblock, free list, root, and anything past the filesystem are never read or truncated as the file's data
+    if (not valid_pointer(cache.geometry, inode.location)):
+        report_bad_pointer(cache.geometry, my_num, inode.location)
+        cache.write(my_num, inode.serialize())
+        return []
+    
+    used_blocks = [inode.location]
     
     # read the contents of the fusedata block at 'location' variable in the file inode
-    location_path = FILES_DIR + "/fusedata." + location_str
-    location_file = open(location_path, 'r+')
-    location_contents = location_file.read()
-    location_file.seek(0) # move the file stream location to the beginning
+    location_contents = cache.read(inode.location)
     
     # test if the data inside location's block is a array of numbers; if it is, indirect should be 1
-    test_data = location_contents.split(',')
-    is_array = True # assume the location block is an array unless proven not guilty in a court of law
-    test_array = [] # list to hold all the possible data blocks in use by this file inode
-    for i in test_data:
-        i = i.strip() # strip any whitespace
-        if (not i.isdigit()):
-            # some of the data inside of location's block does not match the format of an array
-            is_array = False
-            break
-        # if a comma separated value inside of the location block is a number, add it to the list
-        test_array.append(int(i))
+    test_array = parse_index_block(location_contents) # list of all the data blocks in use by this file inode, or None
     
     # if the content at location is not an array of numbers
-    if (not is_array):
-        # set indirect to 0
-        file_list[8] = file_list[8].replace(indirect_str, '0')
+    if (test_array is None):
+        inode.indirect = 0
         # set the size to the length of the data in the location block (max value of BLOCK_SIZE)
-        location_contents = location_contents[0:(BLOCK_SIZE - 1)] # truncate the location's data contents to the size of a block - 1 if necessary (block size - 1 because size < blocksize is requirement)
-        file_list[0] = file_list[0].replace(size_str, str(len(location_contents)))
-        # truncate the file and write the data back to it with a max length of BLOCK_SIZE
-        location_file.seek(0)
-        location_file.truncate()
-        location_file.write(location_contents)
-        print "The size at fusedata.%d is %d bytes.\n" % (my_num, len(location_contents) - 1)
+        location_contents = location_contents[0:(cache.geometry.block_size - 1)] # truncate the location's data contents to the size of a block - 1 if necessary (block size - 1 because size < blocksize is requirement)
+        inode.size = len(location_contents)
+        # write the data back to the block with a max length of BLOCK_SIZE
+        cache.write(inode.location, location_contents)
+        print("The size at fusedata.%d is %d bytes.\n" % (my_num, len(location_contents) - 1))
     else: # we have data that is an array
-        # set indirect to 1
-        file_list[8] = file_list[8].replace(indirect_str, '1')
-        if (size_num > BLOCK_SIZE * len(test_array)):
-            print "Error: size at the file inode located on fusedata.%d is too large for the number of blocks allocated.\n" % my_num
-        elif (size_num < BLOCK_SIZE * (len(test_array) - 1)):
-            print "Error: size at the file inode located on fusedata.%d is too small for the number of blocks allocated.\n" % my_num
+        inode.indirect = 1
+        if (inode.size > cache.geometry.block_size * len(test_array)):
+            print("Error: size at the file inode located on fusedata.%d is too large for the number of blocks allocated.\n" % my_num)
+        elif (inode.size < cache.geometry.block_size * (len(test_array) - 1)):
+            print("Error: size at the file inode located on fusedata.%d is too small for the number of blocks allocated.\n" % my_num)
         else:
-            print "The size at fusedata.%d is %d bytes and therefore the inode points to %d data blocks.\n" % (my_num, size_num, len(test_array))
-        # append the used blocks to the blocks_in_use list
-        for i in test_array:
-            blocks_in_use.append(i)
-    
-    contents = ','.join(file_list)
+            print("The size at fusedata.%d is %d bytes and therefore the inode points to %d data blocks.\n" % (my_num, inode.size, len(test_array)))
+        # the data blocks listed at location are in use too
+        used_blocks.extend(test_array)
     
-    block.seek(0)
-    block.truncate()
-    block.write(contents)
-    block.close()
+    cache.write(my_num, inode.serialize())
+    return used_blocks
+
+
+# the block device and geometry of a worker process, set once by init_worker when the pool starts
+worker_device = None
+worker_geometry = None
+
+
+def init_worker(path, readonly, geometry):
+    global worker_device, worker_geometry
+    worker_device = open_device(path, geometry.block_size, readonly)
+    worker_geometry = geometry
+
+
+# check_file_inode run in a worker process: args is (t, my_num, links, collect), collect saying whether to collect the inode's fields instead of checking them
+# returns (printed output, used blocks, [(block number, contents)] for every block that was changed, FieldColumns or None) for the parent to merge
+def check_file_inode_worker(args):
+    (t, my_num, links, collect) = args
+    cache = BlockCache(worker_device, worker_geometry)
+    fields = FieldColumns() if collect else None
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        used_blocks = check_file_inode(cache, t, my_num, links, fields)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return (output, used_blocks, [(num, cache.blocks[num]) for num in sorted(cache.dirty)], fields)
+
+
+# claim the blocks used by file inode my_num in block_map, reporting pointers outside of the data area, and record them in the manifest
+# used_blocks is None if the inode was corrupt, and [] if its location isn't a valid pointer; links is its hard link count
+def merge_file_inode(cache, my_num, used_blocks, links, block_map, manifest):
+    if (used_blocks is None):
+        return
+    for i in used_blocks:
+        if (valid_pointer(cache.geometry, i)):
+            block_map.claim(i, my_num)
+        else:
+            report_bad_pointer(cache.geometry, my_num, i)
+    # an inode without a valid location isn't recorded, so the next run checks it (and reports its location) again
+    if (manifest is not None and used_blocks):
+        manifest.record_inode(my_num, used_blocks, links)
+
+
+# with a ReadAhead device, prefetch the location block of every file inode in file_inodes (their inode blocks were prefetched by check_tree)
+def prefetch_locations(cache, file_inodes):
+    if (not isinstance(cache.device, ReadAhead)):
+        return
+    for my_num in file_inodes:
+        try:
+            location = parse_file_inode(cache.read(my_num), my_num).location
+            if (valid_pointer(cache.geometry, location)):
+                cache.prefetch([location])
+        except BlockFormatError:
+            pass # check_file_inode reports it
+
+
+'''
+Checks every file inode found by check_tree exactly once, in the order they were found, and claims the blocks they use in block_map.
+file_inodes is check_tree's memo table: an OrderedDict of inode block number --> number of directory entries linking to it, which each inode's linkcount is checked against.
+The inodes don't depend on each other, so with jobs > 1 they are checked by a pool of worker processes.
+The workers' output and changed blocks are merged back in the same order, so the report and the repaired blocks match a serial run.
+With a manifest, an inode whose block and location block haven't changed since the last run, and that has as many links as then, isn't checked again; its recorded blocks are used.
+With a checkpoint, the inodes merged so far are saved whenever one is due; a resumed check passes them back in as checked and skips them.
+With fields (a FieldColumns) the inodes' times and ids are collected for check_fields instead of being checked one by one.
+'''
+def check_file_inodes(cache, t, file_inodes, block_map, jobs=1, path=FILES_DIR, manifest=None, checkpoint=None, checked=None, fields=None):
+    checked = set(checked or [])
+    inodes = [my_num for my_num in file_inodes if (my_num not in checked)]
+
+    # note that my_num has been merged into block_map, and save a checkpoint if one is due
+    def merged(my_num):
+        checked.add(my_num)
+        if (checkpoint is not None and checkpoint.due()):
+            checkpoint.save(cache, t, block_map, file_inodes, manifest, fields, {'phase': 'check_file_inodes', 'checked': sorted(checked)})
+
+    if (manifest is not None):
+        changed_inodes = []
+        for my_num in inodes:
+            used_blocks = manifest.unchanged_inode(cache, my_num, file_inodes[my_num])
+            if (used_blocks is None):
+                changed_inodes.append(my_num)
+            else:
+                merge_file_inode(cache, my_num, used_blocks, file_inodes[my_num], block_map, manifest)
+                merged(my_num)
+        inodes = changed_inodes
+
+    if (jobs > 1 and len(inodes) > 1):
+        pool = Pool(jobs, init_worker, (path, cache.device.readonly, cache.geometry))
+        work = [(t, my_num, file_inodes[my_num], fields is not None) for my_num in inodes]
+        results = pool.imap(check_file_inode_worker, work, max(1, len(work) // (jobs * 4)))
+        for (i, (output, used_blocks, changed, inode_fields)) in enumerate(results):
+            my_num = inodes[i]
+            sys.stdout.write(output)
+            for (num, contents) in changed:
+                cache.write(num, contents)
+            if (inode_fields is not None):
+                fields.extend(inode_fields)
+            merge_file_inode(cache, my_num, used_blocks, file_inodes[my_num], block_map, manifest)
+            merged(my_num)
+        pool.close()
+        pool.join()
+    else:
+        prefetch_locations(cache, inodes)
+        for my_num in inodes:
+            links = file_inodes[my_num]
+            merge_file_inode(cache, my_num, check_file_inode(cache, t, my_num, links, fields), links, block_map, manifest)
+            merged(my_num)
 
 # ------------------------------------------- file inode function ------------------------------------------------- #
 
         
 # ------------------------------------------- directory functions ------------------------------------------------- #
         
-# return the number of entries in the directory, resolve any issues with '.' and '..', and check all dir and inode entries in the directory
-def check_inode_dict(file_list, my_num, parent_num, blocks_in_use):
-    org_entry_list = file_list[2].split('}')
-    # now the entry_list is actually a list with each directory entry
-    entry_list = org_entry_list[0].split(',')
-    temp_list = []
-    for i in range(0, len(entry_list)):
-        # listy contains a string of format: "type:name:block_number"
-        listy = entry_list[i].strip()
-        # listy is now a list with 3 strings in 3 indexes
-        listy = listy.split(':')
-        temp_list.append(listy)
-    # temp_list's indexes each contain a list that has 3 index values: 0 --> type, 1 --> name, 2 --> block_number
+# return the number of entries in the directory and resolve any issues with '.' and '..'
+# the block numbers of sub-directory entries are added to subdirs and those of file inode entries to files
+def check_inode_dict(dir_inode, my_num, parent_num, subdirs, files):
+    entries = dir_inode.entries # list of (type, name, block_number) tuples, type and name being bytes
     found_dot = False # boolean to indicate whether the inode_dict contains '.' or not
     found_dotdot = False # boolean to indicate whether the inode_dict contains '..' or not
-    for entry in temp_list:
-        if (entry[0] == 'd'):
+    for i in range(0, len(entries)):
+        (entry_type, name, block_num) = entries[i]
+        if (entry_type == b'd'):
             # if the '.' or '..' numbers don't match the passed in values, assume the passed in block numbers from the parent directory are the correct values
-            if (entry[1] == '.'):
+            if (name == b'.'):
                 found_dot = True
-                if (int(entry[2]) != my_num):
-                    entry[2] = str(my_num)
-            elif (entry[1] == '..'):
+                if (block_num != my_num):
+                    entries[i] = (b'd', b'.', my_num)
+            elif (name == b'..'):
                 found_dotdot = True
-                if (int(entry[2]) != parent_num):
-                    entry[2] = str(parent_num)
+                if (block_num != parent_num):
+                    entries[i] = (b'd', b'..', parent_num)
             else:
-                # the entry is a sub-directory, so we must check its inode_dict; its number is the entry's number, its parent number is the current directory's number
-                check_dir(int(entry[2]), my_num, blocks_in_use)
-                # since this is a sub-directory, we must add its block number to the list of block numbers in use
-                blocks_in_use.append(int(entry[2]))
-        else: # entry[0] == 'f'
-            # add the file inode to the list of used blocks
-            blocks_in_use.append(int(entry[2]))
-            check_file_inode(int(entry[2]), blocks_in_use)
-
-    # if '.' or '..' weren't found in the inode_dict, add them to temp_list which will be converted back into the block's file
+                # the entry is a sub-directory, so its inode_dict must be checked too; its parent number is the current directory's number
+                subdirs.append(block_num)
+        else: # entry_type == 'f'
+            files.append(block_num)
+
+    # if '.' or '..' weren't found in the inode_dict, add them to the entries which will be written back into the block's file
     if (not found_dot):
-        temp_list.append(['d', '.', str(my_num)])
+        entries.append((b'd', b'.', my_num))
     if (not found_dotdot):
-        temp_list.append(['d', '..', str(parent_num)])
-    
-    listy = []
-    for entry in temp_list:
-        # temp holds a string that is the format of an entry in a directory
-        temp = ':'.join(entry)
-        # listy will hold all the entries as indexes
-        listy.append(temp)
-    # rejoin all the entries separated by a comma and space
-    org_entry_list[0] = ', '.join(listy)
-    # rejoin the file's contents to include a curly brace
-    file_list[2] = '}'.join(org_entry_list)
+        entries.append((b'd', b'..', parent_num))
     
     # return the number of entries in the inode_dict for this directory
-    return len(listy)
-
+    return len(entries)
 
-# checks the data inside the directory stored at fusedata block number referenced by my_num
-def check_dir(my_num, parent_num, blocks_in_use):
-    # read the contents of the fusedata block into the variable: contents
-    block_path = FILES_DIR + "/fusedata." + str(my_num)
-    block = open(block_path, 'r+')
-    contents = block.read()
 
+# checks the data inside the directory stored at fusedata block number referenced by my_num: permissions, times, '.' and '..', and linkcount
+# with fields (a FieldColumns) the times and ids are added to it for check_fields instead of being checked here
+# returns (sub-directory block numbers, file inode block numbers) listed in the directory, or None if the directory is corrupt
+def check_dir(cache, t, my_num, parent_num, fields=None):
     # print an error message and stop checking the directory if the data in the block does not match the format expected
-    if (contents.count('{') != 2 and contents.count('}') != 2):
-        print "Directory metadata in fusedata.%d has been corrupted and does match the expected format. Exitting check of this directory.\n" % my_num
-        return -1
-
-    contents = contents.strip() # strip any whitespace
-    # break contents into a list separated by curly braces '{' and '}'
-    file_list = contents.split('{') # index zero will contain an empty string because directory data starts with a '{'
-    check_permissions(file_list, 'd') # update directory id's and mode if necessary
-
-    linkcount = check_inode_dict(file_list, my_num, parent_num, blocks_in_use)
-
-    # file_meta_data holds size, uid, ..., linkcount, filename_to_inode_dict
-    file_meta_data = file_list[1].split(',') # linkcount is index 7
-    linkcount_data = file_meta_data[7]
-    linkcount_list = linkcount_data.split(':')
-    linkcount_str = linkcount_list[1].strip()
+    try:
+        dir_inode = parse_dir(cache.read(my_num), my_num)
+    except BlockFormatError:
+        print("Directory metadata in fusedata.%d has been corrupted and does match the expected format. Exitting check of this directory.\n" % my_num)
+        return None
+
+    if (fields is None):
+        check_permissions(dir_inode, 'd') # update directory id's and mode if necessary
+        check_entry_times(t, dir_inode, my_num)
+    else:
+        fields.add(my_num, 'd', dir_inode)
+
     # replace the old link count with a possibly updated new one
-    file_meta_data[7] = file_meta_data[7].replace(linkcount_str, str(linkcount))
-    file_list[1] = ','.join(file_meta_data)
+    subdirs = []
+    files = []
+    dir_inode.linkcount = check_inode_dict(dir_inode, my_num, parent_num, subdirs, files)
+
+    cache.write(my_num, dir_inode.serialize())
+    return (subdirs, files)
+
+
+# return (sub-directory block numbers, file inode block numbers) listed in directory my_num without checking or repairing it, or None if it is corrupt
+# a sharded check walks the directories outside its shard this way (see fsshard.py)
+def list_dir(cache, my_num, parent_num):
+    try:
+        dir_inode = parse_dir(cache.read(my_num), my_num)
+    except BlockFormatError:
+        return None
+    subdirs = []
+    files = []
+    check_inode_dict(dir_inode, my_num, parent_num, subdirs, files)
+    return (subdirs, files)
+
+
+# return the (block number, parent block number) pairs a check in scope starts walking from: root, or the scope's subtrees with the parents their '..' entries name
+def subtree_roots(cache, scope):
+    root = cache.geometry.root
+    if (scope is None or scope.subtrees is None):
+        return [(root, root)]
+    roots = []
+    for my_num in scope.subtrees:
+        if (my_num != root and not valid_pointer(cache.geometry, my_num)):
+            print("Error: fusedata.%d can't be a directory, so it was not checked as a subtree.\n" % my_num)
+            continue
+        parent_num = my_num
+        try:
+            for (entry_type, name, block_num) in parse_dir(cache.read(my_num), my_num).entries:
+                if (entry_type == b'd' and name == b'..'):
+                    parent_num = block_num
+        except BlockFormatError:
+            pass # check_dir reports it
+        roots.append((my_num, parent_num))
+    return roots
 
-    contents = '{'.join(file_list)
-    
-    block.seek(0)
-    block.truncate()
-    block.write(contents)
-    block.close()
+
+'''
+Checks every directory reachable from root with check_dir, using an explicit queue of (block number, parent block number) pairs instead of recursion,
+so deep trees can't hit Python's recursion limit.
+order is 'dfs' (a directory's sub-directories are checked before its siblings, like the old recursion) or 'bfs' (the tree is checked level by level).
+A sub-directory entry that points at a directory that was already visited would be a cycle (or a second link to a directory);
+it is reported and not followed, so a corrupt entry can't make the checker loop forever.
+Every file inode found is claimed and added to file_inodes (an OrderedDict, so once however many hardlinks point to it) for check_file_inodes,
+which counts the directory entries that link to it.
+A file entry pointing at a block something else already claimed (that isn't a file inode) is claimed again so it's reported as cross-linked, but it isn't checked as an inode.
+Entries pointing outside of the data area (see valid_pointer) are reported and not followed.
+With a manifest, a directory whose block hasn't changed since the last run isn't checked again; its recorded entries are used.
+As soon as a directory is checked its new sub-directories and file inodes are prefetched, so with a ReadAhead device they're read while the walk goes on.
+The file inodes are left out unless prefetch_inodes is set, for when they're checked in worker processes and the walk would only read them for nothing.
+With a checkpoint, the queue and the visited set are saved between two directories whenever one is due; a resumed check passes them back in as frontier.
+With fields (a FieldColumns) the directories' times and ids are collected for check_fields instead of being checked one by one.
+With a scope (see fsshard.py) the walk starts from its subtrees, and only the directories in its shard are checked; the others are only listed (see list_dir).
+The sub-directories and file inodes found are only claimed by the shard they are in, but every file inode found is counted in file_inodes.
+'''
+def check_tree(cache, t, block_map, file_inodes, order='dfs', manifest=None, checkpoint=None, frontier=None, fields=None, scope=None, prefetch_inodes=True):
+    pending = deque(subtree_roots(cache, scope))
+    visited = set([my_num for (my_num, parent_num) in pending])
+    if (frontier is not None):
+        visited = set(frontier['visited'])
+        pending = deque([(my_num, parent_num) for (my_num, parent_num) in frontier['pending']])
+    while (pending):
+        if (checkpoint is not None and checkpoint.due()):
+            checkpoint.save(cache, t, block_map, file_inodes, manifest, fields, {'phase': 'check_tree', 'pending': list(pending), 'visited': sorted(visited)})
+        if (order == 'bfs'):
+            (my_num, parent_num) = pending.popleft()
+        else:
+            (my_num, parent_num) = pending.pop()
+        mine = (scope is None or scope.owns(my_num))
+        found = None
+        if (manifest is not None):
+            found = manifest.unchanged_dir(cache, my_num, parent_num)
+        if (found is None):
+            found = check_dir(cache, t, my_num, parent_num, fields) if mine else list_dir(cache, my_num, parent_num)
+        if (found is None):
+            continue # corrupt directory
+        (subdirs, files) = found
+        if (manifest is not None):
+            manifest.record_dir(my_num, parent_num, subdirs, files)
+        follow_entries(cache, block_map, file_inodes, visited, pending, my_num, subdirs, files, order, scope, prefetch_inodes)
+
+
+'''
+Handles the entries of directory my_num for check_tree: subdirs and files are the block numbers of its sub-directories and file inodes.
+New sub-directories are claimed, marked visited, and queued on pending; new file inodes are claimed and counted in file_inodes, hardlinks only counted.
+The new sub-directories are prefetched, and so are the new file inodes if prefetch_inodes is set (see check_tree).
+'''
+def follow_entries(cache, block_map, file_inodes, visited, pending, my_num, subdirs, files, order='dfs', scope=None, prefetch_inodes=True):
+    root = cache.geometry.root
+    mine = (scope is None or scope.owns(my_num))
+    found_inodes = []
+    found_subdirs = []
+    for inode_num in files:
+        if (not valid_pointer(cache.geometry, inode_num)):
+            if (mine):
+                report_bad_pointer(cache.geometry, my_num, inode_num)
+        # multiple entries can point to the same file inode (hardlinks), so only claim and queue the inode the first time it is seen, and count the rest
+        elif (inode_num in file_inodes):
+            file_inodes[inode_num] += 1
+        elif (scope is not None and not scope.owns(inode_num)):
+            file_inodes[inode_num] = 1 # its own shard claims and checks it
+        elif (block_map.claim(inode_num, my_num) == 0):
+            file_inodes[inode_num] = 1
+            found_inodes.append(inode_num)
+    # the stack pops from the end, so push the sub-directories in reverse to check them in the order they are listed
+    if (order != 'bfs'):
+        subdirs = subdirs[::-1]
+    for sub_num in subdirs:
+        if (sub_num != root and not valid_pointer(cache.geometry, sub_num)):
+            if (mine):
+                report_bad_pointer(cache.geometry, my_num, sub_num)
+            continue
+        if (sub_num in visited):
+            if (mine):
+                print("Error: fusedata.%d lists fusedata.%d as a sub-directory, but it was already checked. The entry makes a cycle and was not followed.\n" % (my_num, sub_num))
+            continue
+        visited.add(sub_num)
+        # since this is a sub-directory, we must mark its block number as in use
+        if (scope is None or scope.owns(sub_num)):
+            block_map.claim(sub_num, my_num)
+        pending.append((sub_num, my_num))
+        found_subdirs.append(sub_num)
+    # the sub-directories were pushed in reverse for dfs; prefetch them in the order they will be checked, then the inodes
+    if (order != 'bfs'):
+        found_subdirs.reverse()
+    cache.prefetch(found_subdirs + found_inodes if (prefetch_inodes) else found_subdirs)
 
 # ------------------------------------------- directory functions ------------------------------------------------- #
 
 
+# --------------------------------------------- orphan functions -------------------------------------------------- #
+
+# return (kind, what it holds) for block number num past root, like fsparse.identify_block, but telling empty blocks apart from data too
+def classify_block(num, contents):
+    if (not contents):
+        return ('empty', None)
+    return identify_block(contents, num)
+
+
+'''
+Sweeps every block past root that nothing in block_map claims, once the tree and the file inodes have been checked, and returns (kinds, orphans, spare):
+kinds counts the unclaimed blocks that hold data by their classify_block kind, orphans lists the (block number, kind) of the unreachable directories
+and file inodes that no other unreachable directory lists (the tops of the lost subtrees), and spare is an unclaimed empty block (or None).
+Only the blocks that hold data are read (see BlockCache.blocks_with_data), so on an image file the sweep is one pass over the mapped device.
+'''
+def sweep_orphans(cache, block_map):
+    geometry = cache.geometry
+    owners = block_map.owners
+    unclaimed = [num for num in xrange(geometry.root + 1, geometry.max_blocks) if (owners[num] == 0)]
+    holding_data = cache.blocks_with_data(unclaimed)
+    found = set(holding_data)
+    spare = next((num for num in unclaimed if (num not in found)), None)
+    cache.prefetch(holding_data)
+    kinds = {}
+    listed = {} # unreachable directory --> the block numbers its entries point to
+    lost = set()
+    for num in holding_data:
+        contents = cache.read(num)
+        (kind, record) = classify_block(num, contents)
+        kinds[kind] = kinds.get(kind, 0) + 1
+        if (kind == 'directory'):
+            listed[num] = [block_num for (entry_type, name, block_num) in record.entries if (name not in (b'.', b'..'))]
+        if (kind in ('directory', 'file-inode')):
+            lost.add(num)
+
+    # a lost directory or inode that another lost directory lists comes back with it; a cycle of lost directories has no top, so its lowest block is taken as one
+    reached = set()
+    def reach(top):
+        stack = [top]
+        while (stack):
+            num = stack.pop()
+            if (num in lost and num not in reached):
+                reached.add(num)
+                stack.extend(listed.get(num, []))
+    listed_anywhere = set([num for entries in listed.values() for num in entries])
+    tops = []
+    for num in sorted(lost):
+        if (num not in listed_anywhere):
+            tops.append(num)
+            reach(num)
+    for num in sorted(lost):
+        if (num not in reached):
+            tops.append(num)
+            reach(num)
+    orphans = [(num, 'directory' if (num in listed) else 'file-inode') for num in tops]
+    return (kinds, orphans, spare)
+
+
+# print what sweep_orphans found; without lost_found the orphans are only reported, and are cleared with the other free blocks
+def report_orphans(kinds, orphans, lost_found):
+    if (kinds):
+        print("The sweep found %d unreachable blocks holding data: %s.\n" % (sum(kinds.values()), ', '.join(["%d %s" % (kinds[kind], kind) for kind in sorted(kinds)])))
+    if (not lost_found):
+        for (num, kind) in orphans:
+            print("Error: fusedata.%d is a %s that no directory reaches. It is on the free block list and will be cleared; use --lost-found to reattach it.\n" % (num, kind.replace('-', ' ')))
+
+
+# yield the blocks from spare (see sweep_orphans) on that nothing in block_map claims and that hold no data, looking for each one only when it's asked for
+def spare_blocks(cache, block_map, spare):
+    if (spare is None):
+        return
+    owners = block_map.owners
+    for num in xrange(spare, cache.geometry.max_blocks):
+        if (owners[num] == 0 and not cache.blocks_with_data([num])):
+            yield num
+
+
+# add entry to directory record and return its serialized contents, or return None and leave record as it was if they wouldn't fit in block_size bytes
+def add_dir_entry(record, entry, block_size):
+    record.entries.append(entry)
+    record.linkcount = len(record.entries)
+    contents = record.serialize()
+    if (len(contents) <= block_size):
+        return contents
+    record.entries.pop()
+    record.linkcount = len(record.entries)
+    return None
+
+
+# create the directory name under root in block num (root_dir being root's record) and return its record, or None if root has no room for another entry
+def new_lost_found(cache, t, block_map, root_dir, num, name):
+    root = cache.geometry.root
+    root_contents = add_dir_entry(root_dir, (b'd', name, num), cache.geometry.block_size)
+    if (root_contents is None):
+        return None
+    record = DirInode()
+    (record.size, record.uid, record.gid, record.mode) = (0, DIR_UID, DIR_GID, DIR_MODE)
+    (record.atime, record.ctime, record.mtime) = (t, t, t)
+    record.entries = [(b'd', b'.', num), (b'd', b'..', root)]
+    record.linkcount = len(record.entries)
+    cache.write(num, record.serialize())
+    cache.write(root, root_contents)
+    block_map.claim(num, root)
+    print("Created %s in fusedata.%d.\n" % (name.decode('utf-8'), num))
+    return record
+
+
+'''
+Reattaches orphans (see sweep_orphans) to the lost+found directory under root as entries named #<block number>, creating lost+found in block spare if root has none.
+A lost+found directory only takes as many entries as fit in a block; the rest spill into lost+found.1, lost+found.2, ... under root, each in the next spare block.
+Orphans that find no room (no spare block is left, or root is full) aren't reattached; they're reported and cleared with the other free blocks.
+The reattached orphans are then walked from their lost+found with check_tree, which checks and claims them and everything below them and counts their file inodes in file_inodes.
+Returns True if any were reattached, False if there is nowhere to put them.
+'''
+def attach_lost_found(cache, t, block_map, file_inodes, orphans, spare, order='dfs', manifest=None, fields=None, prefetch_inodes=True):
+    geometry = cache.geometry
+    root = geometry.root
+    try:
+        root_dir = parse_dir(cache.read(root), root)
+    except BlockFormatError:
+        print("The root directory is corrupt, so the unreachable directories and file inodes can't be reattached.\n")
+        return False
+    lost_found = None
+    for (entry_type, name, block_num) in root_dir.entries:
+        if (entry_type == b'd' and name == LOST_FOUND and valid_pointer(geometry, block_num) and block_map.owners[block_num] == root):
+            lost_found = block_num
+    if (lost_found is None and spare is None):
+        print("There is no free block to create lost+found in, so the unreachable directories and file inodes can't be reattached.\n")
+        return False
+
+    record = parse_dir(cache.read(lost_found), lost_found) if (lost_found is not None) else None
+    names = set([name for (entry_type, name, block_num) in root_dir.entries])
+    spares = spare_blocks(cache, block_map, spare)
+    lost_found_name = LOST_FOUND
+    attached = [] # (lost+found block number, the orphans reattached to it)
+    if (lost_found is not None):
+        attached.append((lost_found, []))
+    for (i, (num, kind)) in enumerate(orphans):
+        entry = (b'd' if (kind == 'directory') else b'f', b'#%d' % num, num)
+        contents = add_dir_entry(record, entry, geometry.block_size) if (record is not None) else None
+        if (contents is None):
+            # lost+found is full (or there is none yet), so the rest go into a new one
+            lost_found_name = LOST_FOUND
+            k = 0
+            while (lost_found_name in names):
+                k += 1
+                lost_found_name = LOST_FOUND + b'.%d' % k
+            lost_found = next(spares, None)
+            record = new_lost_found(cache, t, block_map, root_dir, lost_found, lost_found_name) if (lost_found is not None) else None
+            contents = add_dir_entry(record, entry, geometry.block_size) if (record is not None) else None
+            if (contents is None):
+                print("There is no room for another lost+found directory, so %d unreachable directories and file inodes weren't reattached. They are on the free block list and will be cleared.\n" % (len(orphans) - i))
+                break
+            names.add(lost_found_name)
+            attached.append((lost_found, []))
+        cache.write(lost_found, contents)
+        attached[-1][1].append((num, kind))
+        print("fusedata.%d is a %s that no directory reaches, so it was reattached to %s as #%d.\n" % (num, kind.replace('-', ' '), lost_found_name.decode('utf-8'), num))
+    if (not any([group for (lost_found, group) in attached])):
+        return False
+
+    # everything claimed so far was checked already; walk on from the orphans
+    owners = block_map.owners
+    visited = set([num for num in xrange(0, geometry.max_blocks) if (owners[num] != 0)])
+    visited.add(root)
+    pending = deque()
+    for (lost_found, group) in attached:
+        follow_entries(cache, block_map, file_inodes, visited, pending, lost_found,
+                       [num for (num, kind) in group if (kind == 'directory')], [num for (num, kind) in group if (kind == 'file-inode')], order, None, prefetch_inodes)
+    check_tree(cache, t, block_map, file_inodes, order, manifest, None, {'pending': list(pending), 'visited': visited}, fields, None, prefetch_inodes)
+    return True
+
+# --------------------------------------------- orphan functions -------------------------------------------------- #
+
+
+# ---------------------------------------------- report functions ------------------------------------------------- #
+
+# return what kind of data block number num holds, judging by its position in geometry and its contents before the check
+def block_kind(num, contents, geometry):
+    if (num == 0):
+        return 'superblock'
+    if (num >= geometry.free_start and num <= geometry.free_end):
+        return 'free-list'
+    kind = identify_block(contents, num)[0]
+    if (kind == 'index'):
+        return 'data' # an index block is reported as the data of the inode that points to it
+    return kind
+
+
+# return a line saying what owns block number num at the end of the check
+def owner_report(geometry, block_map, num):
+    if (num < 0 or num >= geometry.max_blocks):
+        return "fusedata.%d is past the end of the %d block filesystem.\n" % (num, geometry.max_blocks)
+    if (num <= geometry.root):
+        return "fusedata.%d is the %s.\n" % (num, reserved_kind(geometry, num))
+    owners = block_map.owners_of(num)
+    if (not owners):
+        return "fusedata.%d is free.\n" % num
+    return "fusedata.%d is owned by %s.\n" % (num, ', '.join(["fusedata.%d" % k for k in owners]))
+
+
+# return directory entries as [type, name, block number] lists of text, which json can write on Python 3 too
+def entries_json(entries):
+    return [[entry_type.decode('utf-8', 'replace'), name.decode('utf-8', 'replace'), block_num] for (entry_type, name, block_num) in entries]
+
+
+'''
+Yields one dict per fix the check made to the blocks in cache, by comparing every dirty block with what is still on disk.
+Superblocks, directories, and file inodes are compared field by field ({"block", "kind", "field", "old", "new"});
+free list blocks report the block numbers they gain and lose (if any); any other block, or one whose repair changed its kind, reports its old and new size.
+'''
+def proposed_fixes(cache):
+    parsers = {'superblock': parse_superblock, 'directory': parse_dir, 'file-inode': parse_file_inode}
+    for num in sorted(cache.dirty):
+        old = cache.original[num]
+        new = cache.blocks[num]
+        if (old == new):
+            continue # the block would only be created, its contents stay the same
+        kind = block_kind(num, old, cache.geometry)
+        records = None
+        if (kind in parsers):
+            try:
+                records = (parsers[kind](old, num), parsers[kind](new, num))
+            except BlockFormatError:
+                pass # the repair changed what the block holds (e.g. into a free list block), so only its size can be compared
+        if (records is not None):
+            (old_record, new_record) = records
+            for (key, attr) in type(old_record).KEYS:
+                if (getattr(old_record, attr) != getattr(new_record, attr)):
+                    yield {'block': num, 'kind': kind, 'field': key, 'old': getattr(old_record, attr), 'new': getattr(new_record, attr)}
+            if (kind == 'directory' and old_record.entries != new_record.entries):
+                yield {'block': num, 'kind': kind, 'field': 'filename_to_inode_dict', 'old': entries_json(old_record.entries), 'new': entries_json(new_record.entries)}
+        elif (kind == 'free-list'):
+            old_free = set(parse_index_block(old) or [])
+            new_free = set(parse_index_block(new) or [])
+            if (old_free != new_free): # a block only rewritten in the list's own format lists the same free blocks, which isn't a fix
+                yield {'block': num, 'kind': kind, 'field': 'free_blocks', 'added': sorted(new_free - old_free), 'removed': sorted(old_free - new_free)}
+        else:
+            yield {'block': num, 'kind': kind, 'field': 'contents', 'old_size': len(old), 'new_size': len(new)}
+
+# ---------------------------------------------- report functions ------------------------------------------------- #
+
+
+# ----------------------------------------------- run functions --------------------------------------------------- #
+
+# the block parsers whose time is counted as parse time by --stats
+PARSERS = ['parse_superblock', 'parse_dir', 'parse_file_inode', 'parse_index_block']
+
+
+'''
+Runs every phase of a check of the filesystem at path and returns (its BlockCache, its BlockMap); the repairs are flushed unless check_only is set,
+in which case the cache still holds every proposed fix (see proposed_fixes) and nothing is written.
+Each phase is timed in stats; with timed_io the device's reads/writes and the block parsers are timed too (see fsstats.py).
+The geometry comes from the superblock; max_blocks, block_size, and free_end override it (see load_geometry).
+With read_ahead > 0 the directory walk prefetches blocks with that many reader threads (see blockdev.ReadAhead).
+With a checkpoint_path the walk and the inode checks save a checkpoint every checkpoint_every seconds, and with resume a check picks up
+from the checkpoint saved there (see fscheckpoint.py). The checkpoint is removed once the check is done.
+With a scope (see fsshard.py) only part of the filesystem is checked and nothing is written: the free block list is left alone,
+and the scope's block map and repairs are saved to shard_output for merge_shards.
+With sweep the blocks nothing reaches are swept for lost directories and file inodes (see sweep_orphans), and with lost_found they're reattached under lost+found.
+With a journal_path the repairs are journaled there before they are written, and a journal a killed run left unfinished there is replayed first (see fsjournal.py).
+With warm (a fsdaemon.CheckDaemon) the check goes through warm.cache, its device left open and the blocks it has read kept, instead of opening path,
+and warm.manifest is used as the manifest (it is saved to manifest_path too, if there is one).
+'''
+def check_filesystem(path, jobs=1, order='dfs', check_only=False, manifest_path=None, stats=None, timed_io=False,
+                     max_blocks=None, block_size=BLOCK_SIZE, free_end=None, read_ahead=0,
+                     checkpoint_path=None, resume=False, checkpoint_every=CHECKPOINT_EVERY, scope=None, shard_output=None, sweep=False, lost_found=False,
+                     journal_path=None, warm=None):
+    if (stats is None):
+        stats = Stats()
+    checkpoint = None
+    state = None
+    if (checkpoint_path):
+        checkpoint = Checkpoint(checkpoint_path, checkpoint_every, scope.describe() if (scope is not None) else None)
+        if (resume):
+            state = Checkpoint.load(checkpoint_path)
+        else:
+            checkpoint.owned = True # a check that doesn't resume starts over, so any checkpoint already there is out of date
+    # a resumed check judges times against the time the check first started at
+    t = state['time'] if (state is not None) else int(time())
+    journal = None
+    if (journal_path and not check_only and scope is None):
+        finish_journal(path, journal_path, block_size)
+        journal = Journal(journal_path)
+    if (warm is not None):
+        cache = warm.cache
+        device = cache.device
+    else:
+        device = open_device(path, block_size, check_only or scope is not None)
+        if (read_ahead > 0):
+            device = ReadAhead(device, read_ahead)
+        cache = BlockCache(device)
+    # with timed_io the device and the parsers are timed until the check is done (a warm device is the daemon's, and isn't timed)
+    with stats.instrument(device, globals(), PARSERS, timed_io and warm is None):
+        with stats.phase('check_devId'):
+            check_devId(cache)
+        with stats.phase('check_superblock'):
+            cache.geometry = load_geometry(cache, max_blocks, block_size, free_end)
+            check_superblock(cache, t)
+        block_map = BlockMap(cache.geometry)
+        manifest = None
+        if (warm is not None):
+            manifest = warm.manifest
+        elif (manifest_path):
+            manifest = Manifest.load(manifest_path)
+        file_inodes = OrderedDict()
+        fields = FieldColumns()
+        position = {'phase': 'check_tree'}
+        if (state is not None and not checkpoint.matches(state, cache)):
+            print("The checkpoint in %s was saved on a different filesystem or by a check of a different scope, so the check starts from the beginning.\n" % checkpoint_path)
+            state = None
+        if (state is not None):
+            Checkpoint.restore(state, cache, block_map, file_inodes, manifest, fields)
+            position = state['position']
+            print("Resuming the check from the checkpoint in %s (%s, %d file inodes found so far).\n" % (checkpoint_path, position['phase'], len(file_inodes)))
+        # file inodes checked in worker processes are read there, so the walk only prefetches them if the manifest is going to hash them here
+        prefetch_inodes = (jobs <= 1 or manifest is not None)
+        # one pass over the tree checks permissions, times, links, '.' and '..' of every directory and finds every file inode
+        with stats.phase('check_tree'):
+            if (position['phase'] == 'check_tree'):
+                check_tree(cache, t, block_map, file_inodes, order, manifest, checkpoint, position if (state is not None) else None, fields, scope, prefetch_inodes)
+        if (scope is not None):
+            # a shard only checks its own file inodes; in subtrees the link counts are missing the entries outside them
+            file_inodes = OrderedDict([(num, links if (scope.subtrees is None) else None) for (num, links) in file_inodes.items() if (scope.owns(num))])
+        # then the file inodes' linkcount, indirect, and size are checked, in parallel if asked to
+        with stats.phase('check_file_inodes'):
+            check_file_inodes(cache, t, file_inodes, block_map, jobs, path, manifest, checkpoint, position.get('checked'), fields)
+        # everything reachable is claimed now, so whatever else holds a directory or file inode is lost
+        if (sweep or lost_found):
+            with stats.phase('sweep'):
+                (kinds, orphans, spare) = sweep_orphans(cache, block_map)
+                report_orphans(kinds, orphans, lost_found)
+                stats.orphans = kinds
+                links = dict(file_inodes)
+                if (lost_found and orphans and attach_lost_found(cache, t, block_map, file_inodes, orphans, spare, order, manifest, fields, prefetch_inodes)):
+                    # check the file inodes found under lost+found, and again the ones the lost directories link to as well
+                    checked = [num for num in links if (file_inodes[num] == links[num])]
+                    check_file_inodes(cache, t, file_inodes, block_map, jobs, path, manifest, None, checked, fields)
+        # and the times and ids of every directory and file inode found are checked in one pass over their columns
+        with stats.phase('check_fields'):
+            check_fields(cache, t, fields)
+        stats.fields = fields.summary(t)
+
+        if (scope is not None):
+            save_shard(shard_output, scope, cache, block_map)
+            print("The block map and the repairs to %d blocks were saved to %s; merge every shard with --merge to apply them.\n" % (len(cache.dirty), shard_output))
+        else:
+            with stats.phase('update_freeblock_list'):
+                update_freeblock_list(cache, block_map)
+            if (not check_only):
+                # nothing has been written yet; write back only the blocks that were changed
+                with stats.phase('flush'):
+                    cache.flush(journal)
+                if (manifest is not None):
+                    manifest.finish(cache)
+                    if (manifest_path):
+                        manifest.save(manifest_path)
+        if (checkpoint is not None):
+            checkpoint.remove()
+    if (warm is None):
+        device.close()
+    return (cache, block_map)
+
+
+'''
+Merges the shard files at shard_paths (see fsshard.py), all saved by scoped checks of the filesystem at path, and returns (its BlockCache, its BlockMap)
+like check_filesystem: the superblock is checked again, every shard's repairs are applied, and the shards' block maps are combined, so a block that
+shards claim for different owners is reported as cross-linked. The free block list is only rewritten if the shards cover the whole tree between them.
+The repairs are flushed unless check_only is set, through the journal at journal_path if there is one (see check_filesystem).
+'''
+def merge_shards(path, shard_paths, check_only=False, stats=None, max_blocks=None, block_size=BLOCK_SIZE, free_end=None, journal_path=None):
+    if (stats is None):
+        stats = Stats()
+    t = int(time())
+    journal = None
+    if (journal_path and not check_only):
+        finish_journal(path, journal_path, block_size)
+        journal = Journal(journal_path)
+    device = open_device(path, block_size, check_only)
+    cache = BlockCache(device)
+    with stats.phase('check_devId'):
+        check_devId(cache)
+    with stats.phase('check_superblock'):
+        cache.geometry = load_geometry(cache, max_blocks, block_size, free_end)
+        check_superblock(cache, t)
+    block_map = BlockMap(cache.geometry)
+    scopes = []
+    repaired_by = {} # block number --> shard file whose repair was applied
+    with stats.phase('merge'):
+        for shard_path in shard_paths:
+            shard = load_shard(shard_path)
+            if (shard is None):
+                print("%s is not a shard file.\n" % shard_path)
+                exit(1)
+            if (shard['fingerprint'] != fingerprint(cache)):
+                print("%s was saved by a check of a different filesystem.\n" % shard_path)
+                exit(1)
+            scopes.append(shard['scope'])
+            owners = shard['owners']
+            for num in xrange(0, len(owners)):
+                if (owners[num] != 0):
+                    block_map.claim(num, owners[num])
+            for (num, others) in shard['cross_links']:
+                for owner in others:
+                    block_map.claim(num, owner)
+            # the superblock was checked again above; every other repair is applied as the shard made it
+            for (num, contents) in shard['repaired']:
+                if (num == 0):
+                    continue
+                if (num in repaired_by and cache.read(num) != contents):
+                    print("Error: %s and %s repaired fusedata.%d differently; the repair from %s was kept.\n" % (repaired_by[num], shard_path, num, repaired_by[num]))
+                    continue
+                cache.write(num, contents)
+                repaired_by[num] = shard_path
+    with stats.phase('update_freeblock_list'):
+        if (covers_filesystem(scopes)):
+            update_freeblock_list(cache, block_map)
+        else:
+            report_cross_links(block_map)
+            print("The shards don't cover the whole filesystem, so the free block list was not rebuilt.\n")
+
+    if (not check_only):
+        with stats.phase('flush'):
+            cache.flush(journal)
+    device.close()
+    return (cache, block_map)
+
+
+'''
+Writes the new contents of every block in the journal at journal_path to the filesystem at path again, or with undo their old contents,
+and returns the journal (see fsjournal.py). Both can be repeated, and a replay after an undo makes the repairs again;
+a journal that is already applied isn't replayed, and one already undone isn't undone again.
+Exits if there is no journal at journal_path, or if it doesn't belong to this filesystem as it is now.
+'''
+def replay_journal(path, journal_path, undo=False, block_size=BLOCK_SIZE):
+    journal = Journal.load(journal_path)
+    if (journal is None):
+        print("%s is not a journal.\n" % journal_path)
+        exit(1)
+    if (journal.state == ('undone' if (undo) else 'applied')):
+        print("The %d blocks in %s were already %s.\n" % (len(journal.entries), journal_path, journal.state))
+        return journal
+    device = open_device(path, block_size)
+    mismatches = journal.mismatches(device)
+    if (mismatches):
+        print("Error: fusedata.%s hold%s neither what %s was written over nor what it wrote, so it was not applied to %s.\n"
+              % (', fusedata.'.join([str(num) for num in mismatches[0:10]]), 's' if (len(mismatches) == 1) else '', journal_path, path))
+        device.close()
+        exit(1)
+    journal.apply(device, undo)
+    device.close()
+    print("%s the %d blocks in %s.\n" % ('Undid' if (undo) else 'Replayed', len(journal.entries), journal_path))
+    return journal
+
+
+# replay the journal a killed run left at journal_path before the filesystem at path is checked again, so the check starts from its finished repairs
+def finish_journal(path, journal_path, block_size=BLOCK_SIZE):
+    journal = Journal.load(journal_path)
+    if (journal is not None and journal.state == 'committed'):
+        print("The repairs in %s were not all written; replaying them first.\n" % journal_path)
+        replay_journal(path, journal_path, False, block_size)
+
+# ----------------------------------------------- run functions --------------------------------------------------- #
+
+
 # ----------------------------------- END OF FILESYSTEM CHECKER FUNCTIONS ----------------------------------------- #
 
 
 
 
 def main():
-    check_devId()
-    check_superblock(int(time()))
-    blocks_in_use = []
-    check_dir(ROOT, ROOT, blocks_in_use)
-    update_freeblock_list(blocks_in_use)
-    check_times()
+    parser = argparse.ArgumentParser(description="Check and repair a fusedata filesystem.")
+    parser.add_argument('path', nargs='?', default=FILES_DIR, help="fusedata.N directory or single-file image to check (default: %s)" % FILES_DIR)
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help="check file inodes with N worker processes (default: 1)")
+    parser.add_argument('--order', choices=['dfs', 'bfs'], default='dfs', help="order the directory tree is walked in (default: dfs)")
+    parser.add_argument('--check-only', action='store_true',
+                        help="open every block read-only and print the fixes that would be made as JSON lines on stdout instead of making them (messages go to stderr)")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="incremental check: only check directories and inodes whose blocks changed since the run that saved FILE, then save FILE for the next run")
+    parser.add_argument('--read-ahead', type=int, default=0, metavar='N',
+                        help="read the blocks of the directories and inodes the walk is about to check with N background threads, for slow storage (default: 0, off)")
+    parser.add_argument('--stats', action='store_true',
+                        help="print a JSON summary of the run to stderr: seconds per phase, blocks and bytes read and written, and I/O vs parse time")
+    parser.add_argument('--profile', metavar='FILE', help="run the check under cProfile and save the profile to FILE (read it with pstats)")
+    parser.add_argument('--blocks', type=int, metavar='N', help="number of blocks on the filesystem (default: maxBlocks from the superblock)")
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, metavar='BYTES', help="bytes per block (default: %d)" % BLOCK_SIZE)
+    parser.add_argument('--owner', type=int, action='append', default=[], metavar='N',
+                        help="after the check, print which directories/inodes own block N (can be given more than once)")
+    parser.add_argument('--free-end', type=int, metavar='N', help="last block of the free block list; root is the next block (default: from the superblock)")
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help="save the progress of the check to FILE every --checkpoint-every seconds, so an interrupted check can be resumed; removed when the check is done")
+    parser.add_argument('--checkpoint-every', type=float, default=CHECKPOINT_EVERY, metavar='SECS', help="seconds between checkpoints (default: %d)" % CHECKPOINT_EVERY)
+    parser.add_argument('--resume', action='store_true', help="carry on from the checkpoint in --checkpoint FILE if there is one, instead of starting over")
+    parser.add_argument('--subtree', type=int, action='append', metavar='N',
+                        help="only check the directory tree below directory N (can be given more than once); needs --shard-output")
+    parser.add_argument('--shard', metavar='K/N', help="only check the directories and file inodes in shard K of N (see fsshard.py); needs --shard-output")
+    parser.add_argument('--shard-output', metavar='FILE', help="where a --subtree or --shard check saves its block map and repairs, for --merge")
+    parser.add_argument('--merge', nargs='+', metavar='FILE', help="instead of checking, apply the repairs and combine the block maps of these shard files")
+    parser.add_argument('--sweep', action='store_true', help="sweep the blocks nothing reaches for lost directories and file inodes and report them")
+    parser.add_argument('--lost-found', action='store_true', help="sweep like --sweep and reattach what is found to lost+found under root instead of clearing it")
+    parser.add_argument('--journal', metavar='FILE',
+                        help="save the old and new contents of every repaired block to FILE before writing them, so the repairs can be replayed or undone (see fsjournal.py)")
+    parser.add_argument('--replay', metavar='FILE', help="instead of checking, write the repairs in journal FILE again, e.g. after a run was killed while writing them")
+    parser.add_argument('--undo', metavar='FILE', help="instead of checking, write back the blocks the repairs in journal FILE were written over")
+    args = parser.parse_args()
+    if (args.replay or args.undo):
+        if (args.replay and args.undo):
+            parser.error("--replay and --undo can't be used together")
+        replay_journal(args.path, args.replay or args.undo, bool(args.undo), args.block_size)
+        return
+    if (args.resume and not args.checkpoint):
+        parser.error("--resume needs --checkpoint FILE")
+    if (args.journal and args.check_only):
+        parser.error("--check-only doesn't write anything, so --journal can't be used with it")
+    scope = None
+    if (args.subtree or args.shard):
+        if (not args.shard_output):
+            parser.error("--subtree and --shard need --shard-output FILE")
+        if (args.manifest):
+            parser.error("--manifest can't be used with --subtree or --shard")
+        if (args.sweep or args.lost_found):
+            parser.error("--sweep and --lost-found need the whole tree, so they can't be used with --subtree or --shard")
+        if (args.journal):
+            parser.error("--subtree and --shard don't write anything, so --journal can't be used with them; use it with --merge")
+        try:
+            scope = Scope.parse(args.subtree, args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if (args.check_only):
+        # keep stdout for the JSON lines
+        report = sys.stdout
+        sys.stdout = sys.stderr
+
+    stats = Stats()
+    run = lambda: check_filesystem(args.path, args.jobs, args.order, args.check_only, args.manifest, stats, args.stats,
+                                   args.blocks, args.block_size, args.free_end, args.read_ahead, args.checkpoint, args.resume, args.checkpoint_every,
+                                   scope, args.shard_output, args.sweep, args.lost_found, args.journal)
+    if (args.merge):
+        run = lambda: merge_shards(args.path, args.merge, args.check_only, stats, args.blocks, args.block_size, args.free_end, args.journal)
+    if (args.profile):
+        profiler = cProfile.Profile()
+        (cache, block_map) = profiler.runcall(run)
+        profiler.dump_stats(args.profile)
+    else:
+        (cache, block_map) = run()
+
+    if (args.check_only):
+        for fix in proposed_fixes(cache):
+            report.write(json.dumps(fix, sort_keys=True) + '\n')
+    else:
+        print("%d bytes written to %d blocks.\n" % (cache.bytes_written, cache.blocks_written))
+    for num in args.owner:
+        print(owner_report(cache.geometry, block_map, num))
+    if (args.stats):
+        sys.stderr.write(json.dumps(stats.summary(cache), sort_keys=True) + '\n')
 
 
 # run main() when csefsck.py is executed
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+'''
+
+    Checkpoints for long-running checks
+
+    With a checkpoint file, csefsck.py saves where it is every so often while it walks the directory tree and checks the file inodes:
+        check_tree:         the directories still to be checked (the traversal frontier) and the ones already visited
+        check_file_inodes:  the file inodes already checked
+    plus everything the check has found so far: the block map, the file inodes and their link counts, the manifest records,
+    the times and ids collected for check_fields, and the new contents of every block it has repaired (nothing is flushed until the end of the run, so the repairs only live in the cache).
+
+    csefsck.py --resume loads the checkpoint and carries on from there instead of starting over. The checkpoint remembers the
+    time the check started at, so times are judged the same way before and after the restart, and the on-disk superblock and
+    geometry it was taken on (and the scope of a sharded check, see fsshard.py), so it is never applied to a different filesystem or check.
+    A finished check removes its checkpoint.
+
+    The file is zlib compressed JSON; block contents, the block map, and the field columns are stored as base64.
+
+'''
+
+from array import array
+from base64 import b64encode, b64decode
+from time import time
+import hashlib
+import json
+import os
+import zlib
+
+CHECKPOINT_VERSION = 2
+CHECKPOINT_EVERY   = 60 # seconds between checkpoints
+
+
+# return the contents of block number num as they are on the device, i.e. before the check's repairs
+def on_disk(cache, num):
+    if (num in cache.dirty):
+        return cache.original[num]
+    return cache.read(num)
+
+
+# return what identifies the filesystem cache is checking: the hash of its superblock on disk and its geometry
+def fingerprint(cache):
+    geometry = cache.geometry
+    return {'superblock': hashlib.sha1(on_disk(cache, 0)).hexdigest(),
+            'geometry': [geometry.max_blocks, geometry.block_size, geometry.free_start, geometry.free_end]}
+
+
+# return array as base64 text, and back
+def pack_array(values):
+    return b64encode(values.tobytes() if hasattr(values, 'tobytes') else values.tostring()).decode('ascii')
+
+
+def unpack_array(text, typecode='i'):
+    values = array(typecode)
+    data = b64decode(text)
+    if (hasattr(values, 'frombytes')):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+'''
+path is where the checkpoints are written; due() says when every seconds have passed since the last one.
+tag is anything JSON can hold that tells checks of the same filesystem apart (a sharded check's scope); a checkpoint only matches a check with the same tag.
+Saving goes through a temporary file, so a check killed while saving still has its previous checkpoint.
+'''
+class Checkpoint(object):
+    def __init__(self, path, every=CHECKPOINT_EVERY, tag=None):
+        self.path = path
+        self.every = every
+        self.tag = tag
+        self.last = time()
+        self.owned = False # True once this check saved a checkpoint or matched the one it loaded, so it's this check's to remove
+
+    # return True if it's time for the next checkpoint
+    def due(self):
+        return (time() - self.last >= self.every)
+
+    '''
+    Save the state of a check that started at time t: its cache (the repaired blocks), block_map, file_inodes, manifest (or None), and fields (a csefsck.FieldColumns),
+    and where it is, as position: a dict with the 'phase' it is in and what that phase needs to go on (see check_tree and check_file_inodes).
+    '''
+    def save(self, cache, t, block_map, file_inodes, manifest, fields, position):
+        state = {'version': CHECKPOINT_VERSION, 'time': t, 'fingerprint': fingerprint(cache), 'tag': self.tag, 'position': position,
+                 'owners': pack_array(block_map.owners), 'cross_links': [[num, owners] for (num, owners) in block_map.cross_links.items()],
+                 'file_inodes': [[num, links] for (num, links) in file_inodes.items()],
+                 'repaired': [[num, b64encode(cache.blocks[num]).decode('ascii')] for num in sorted(cache.dirty)],
+                 'fields': dict([(name, [getattr(fields, name).typecode, pack_array(getattr(fields, name))]) for name in fields.COLUMNS])}
+        if (manifest is not None):
+            state['manifest'] = {'dirs': manifest.dirs, 'inodes': manifest.inodes}
+        tmp_path = self.path + '.tmp'
+        fh = open(tmp_path, 'wb')
+        fh.write(zlib.compress(json.dumps(state).encode('utf-8')))
+        fh.close()
+        os.rename(tmp_path, self.path)
+        self.last = time()
+        self.owned = True
+
+    # return the state saved at path, or None if there is none (or it can't be read)
+    @staticmethod
+    def load(path):
+        try:
+            fh = open(path, 'rb')
+            state = json.loads(zlib.decompress(fh.read()).decode('utf-8'))
+            fh.close()
+        except (IOError, OSError, ValueError, zlib.error):
+            return None
+        if (state.get('version') != CHECKPOINT_VERSION):
+            return None
+        return state
+
+    # return True if state was saved by a check with this tag of the filesystem cache is checking (its geometry must already be loaded)
+    def matches(self, state, cache):
+        self.owned = (state['fingerprint'] == fingerprint(cache) and state.get('tag') == self.tag)
+        return self.owned
+
+    # put the block map, file inodes, manifest records, field columns, and repaired blocks of state back into a fresh check's objects
+    @staticmethod
+    def restore(state, cache, block_map, file_inodes, manifest, fields):
+        block_map.owners = unpack_array(state['owners'])
+        block_map.cross_links = dict([(num, owners) for (num, owners) in state['cross_links']])
+        for (num, links) in state['file_inodes']:
+            file_inodes[num] = links
+        for (name, (typecode, text)) in state['fields'].items():
+            setattr(fields, name, unpack_array(text, str(typecode)))
+        if (manifest is not None and 'manifest' in state):
+            manifest.dirs = dict([(int(num), entry) for (num, entry) in state['manifest']['dirs'].items()])
+            manifest.inodes = dict([(int(num), entry) for (num, entry) in state['manifest']['inodes'].items()])
+        # reading the block first leaves the cache exactly as the repair did: the original contents from disk, the new ones dirty
+        for (num, contents) in state['repaired']:
+            cache.read(num)
+            cache.write(num, b64decode(contents))
+
+    # remove the checkpoint once the check is done, unless it belongs to another check
+    def remove(self):
+        if (self.owned and os.path.exists(self.path)):
+            os.remove(self.path)
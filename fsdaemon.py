@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+'''
+
+    Check daemon
+
+    Instead of starting csefsck.py over every few minutes, which reads and parses every block each time, the daemon stays up with the filesystem
+    opened, every block it has read in memory (its BlockCache), and the manifest of its last check (see fsmanifest.py), and answers check requests
+    on a Unix socket. Between checks it watches the filesystem for blocks that change, and only drops those from the cache, so a check reads
+    just the changed blocks again and, through the manifest, only parses and checks the directories and file inodes whose blocks changed.
+
+        python fsdaemon.py /fusedata --socket /tmp/csefsck.sock [--jobs N --order dfs|bfs --sweep --lost-found --journal FILE --manifest FILE ...]
+        python fsdaemon.py --socket /tmp/csefsck.sock --request check [--check-only]
+        python fsdaemon.py --socket /tmp/csefsck.sock --request status
+        python fsdaemon.py --socket /tmp/csefsck.sock --request stop
+
+    A check request prints what csefsck.py would, and with --check-only the proposed fixes as JSON lines on stdout (messages go to stderr).
+
+    Watching for changes
+    ----------------------------------------------------------------------------------------------------------------------
+        inotify     a fusedata.N directory is watched with inotify (through ctypes, so on Linux only), which names the blocks that changed
+        polling     without inotify, or with --poll, every fusedata.N file is stat()ed before each check and the ones whose time or size changed are dropped
+        images      an image file is stat()ed before each check; if it changed, every cached block is compared with the image
+                    (a write through another process's mmap may only change the image's time once that process syncs it)
+    If inotify loses events (its queue overflowed), every cached block is compared with the device, like an image.
+    ----------------------------------------------------------------------------------------------------------------------
+
+    Protocol: the client sends one JSON line, {"request": "check" | "status" | "stop", "check_only": true | false}, and the daemon answers with one JSON line
+    and closes the connection. Requests are answered one at a time.
+
+'''
+
+from __future__ import print_function
+
+from time import time
+import argparse
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+try:
+    from StringIO import StringIO
+except ImportError: # Python 3
+    from io import StringIO
+
+# inotify is optional: without it (not Linux, or no libc to load) the filesystem is polled
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (ImportError, OSError, AttributeError):
+    libc = None
+
+from blockdev import open_device
+from csefsck import BlockCache, check_filesystem, proposed_fixes, BLOCK_SIZE
+from fsmanifest import Manifest
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = os.O_NONBLOCK
+EVENT          = struct.Struct('iIII') # wd, mask, cookie, length of the name that follows
+
+
+# return the block number of a fusedata.N file name, or None for any other name
+def block_of(name):
+    if (name.startswith('fusedata.') and name[9:].isdigit()):
+        return int(name[9:])
+    return None
+
+
+'''
+Watches a fusedata.N directory with inotify. changes() returns the numbers of the blocks whose files were written, created, renamed, or removed
+since it was last called, or None if there were too many events to keep track of.
+'''
+class InotifyWatcher(object):
+    kind = 'inotify'
+
+    def __init__(self, files_dir):
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if (self.fd < 0 or libc.inotify_add_watch(self.fd, files_dir.encode('utf-8'), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0):
+            raise OSError(ctypes.get_errno(), "can't watch %s with inotify" % files_dir)
+
+    def fileno(self):
+        return self.fd
+
+    def changes(self):
+        changed = set()
+        while (True):
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                break # nothing more to read
+            offset = 0
+            while (offset < len(data)):
+                (wd, mask, cookie, length) = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += EVENT.size + length
+                if (mask & IN_Q_OVERFLOW):
+                    return None
+                num = block_of(name)
+                if (num is not None):
+                    changed.add(num)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+'''
+Polls a fusedata.N directory: changes() stats every fusedata.N file and returns the numbers of the blocks whose files are new, gone,
+or have a different time or size than the last time it was called.
+'''
+class PollWatcher(object):
+    kind = 'poll'
+
+    def __init__(self, files_dir):
+        self.files_dir = files_dir
+        self.seen = self.scan()
+
+    # return block number --> (modification time, size) of every fusedata.N file
+    def scan(self):
+        seen = {}
+        for name in os.listdir(self.files_dir):
+            num = block_of(name)
+            if (num is not None):
+                st = os.stat(os.path.join(self.files_dir, name))
+                seen[num] = (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+        return seen
+
+    def fileno(self):
+        return None
+
+    def changes(self):
+        (before, self.seen) = (self.seen, self.scan())
+        return set([num for num in set(before) | set(self.seen) if (before.get(num) != self.seen.get(num))])
+
+    def close(self):
+        pass
+
+
+# Watches an image file: changes() returns None (compare every cached block) if its time or size changed since the last time it was called, else no blocks
+class ImageWatcher(object):
+    kind = 'image'
+
+    def __init__(self, path):
+        self.path = path
+        self.seen = self.scan()
+
+    def scan(self):
+        st = os.stat(self.path)
+        return (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+
+    def fileno(self):
+        return None
+
+    def changes(self):
+        (before, self.seen) = (self.seen, self.scan())
+        if (before != self.seen):
+            return None
+        return set()
+
+    def close(self):
+        pass
+
+
+# return the watcher for the filesystem at path: inotify for a directory unless poll is set or inotify isn't there, else polling
+def make_watcher(path, poll=False):
+    if (not os.path.isdir(path)):
+        return ImageWatcher(path)
+    if (libc is not None and not poll):
+        try:
+            return InotifyWatcher(path)
+        except OSError:
+            pass
+    return PollWatcher(path)
+
+
+'''
+Keeps the filesystem at path open with its cache and the manifest of the last check that wrote its repairs, and checks it on request.
+options are passed on to csefsck.check_filesystem with every check (jobs, order, sweep, lost_found, journal_path, ...).
+'''
+class CheckDaemon(object):
+    def __init__(self, path, options, manifest_path=None, poll=False, block_size=BLOCK_SIZE):
+        self.path = path
+        self.options = options
+        self.manifest_path = manifest_path
+        self.cache = BlockCache(open_device(path, block_size))
+        self.manifest = Manifest.load(manifest_path) if (manifest_path) else Manifest()
+        self.watcher = make_watcher(path, poll)
+        self.checks = 0
+        self.changed = 0 # blocks dropped from the cache since the last check (the ones the last check wrote itself included)
+        self.started = time()
+
+    # drop the blocks that changed since the last time from the cache
+    def refresh(self):
+        changed = self.watcher.changes()
+        if (changed is None):
+            device = self.cache.device
+            changed = [num for (num, contents) in self.cache.blocks.items() if ((device.read(num) or b'') != contents)]
+        self.cache.forget(changed)
+        self.changed += len(changed)
+
+    # check the filesystem (without writing anything if check_only) and return the reply to the request
+    def check(self, check_only=False):
+        start = time()
+        self.refresh()
+        (changed, self.changed) = (self.changed, 0)
+        cache = self.cache
+        (cache.blocks_read, cache.bytes_read, cache.blocks_written, cache.bytes_written) = (0, 0, 0, 0)
+        # this check records its own directories and inodes; the ones of the last check that wrote its repairs stay the previous ones
+        (self.manifest.dirs, self.manifest.inodes) = ({}, {})
+        (stdout, sys.stdout) = (sys.stdout, StringIO())
+        reply = {}
+        try:
+            check_filesystem(self.path, check_only=check_only, manifest_path=self.manifest_path, warm=self, **self.options)
+            if (check_only):
+                reply['fixes'] = list(proposed_fixes(cache))
+            else:
+                self.manifest = self.manifest.carry_over()
+        except SystemExit as e:
+            reply['exit'] = e.code
+        except Exception as e:
+            # the daemon outlives a check that fails; the client reports it
+            reply['error'] = "%s: %s" % (type(e).__name__, e)
+            reply['exit'] = 1
+        finally:
+            reply['messages'] = sys.stdout.getvalue()
+            sys.stdout = stdout
+            # a check that exited early, or only proposed its fixes, leaves them in the cache but not on disk
+            cache.discard()
+        self.checks += 1
+        reply.update({'changed_blocks': changed, 'blocks_read': cache.blocks_read, 'blocks_written': cache.blocks_written,
+                      'bytes_written': cache.bytes_written, 'secs': time() - start})
+        return reply
+
+    def status(self):
+        return {'path': self.path, 'watcher': self.watcher.kind, 'checks': self.checks, 'cached_blocks': len(self.cache.blocks),
+                'manifest_dirs': len(self.manifest.previous_dirs), 'manifest_inodes': len(self.manifest.previous_inodes), 'changed_blocks': self.changed, 'uptime_secs': time() - self.started}
+
+    # answer the requests on the Unix socket at socket_path until a stop request (or SIGTERM)
+    def serve(self, socket_path):
+        server = listen(socket_path)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            stopped = False
+            while (not stopped):
+                watched = [server] + ([self.watcher] if (self.watcher.fileno() is not None) else [])
+                (readable, writable, failed) = select.select(watched, [], [])
+                if (self.watcher in readable):
+                    self.refresh()
+                if (server in readable):
+                    (conn, address) = server.accept()
+                    request = read_message(conn)
+                    if (request.get('request') == 'check'):
+                        reply = self.check(bool(request.get('check_only')))
+                    elif (request.get('request') == 'status'):
+                        reply = self.status()
+                    elif (request.get('request') == 'stop'):
+                        reply = {'stopped': True}
+                        stopped = True
+                    else:
+                        reply = {'error': "unknown request %r" % request.get('request')}
+                    send_message(conn, reply)
+                    conn.close()
+        finally:
+            server.close()
+            os.remove(socket_path)
+            self.watcher.close()
+            self.cache.device.close()
+
+
+# return a socket listening at socket_path, replacing a socket file left there by a daemon that is gone; exits if a daemon is still answering there
+def listen(socket_path):
+    if (os.path.exists(socket_path)):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print("A daemon is already listening on %s.\n" % socket_path)
+            sys.exit(1)
+        except socket.error:
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(5)
+    return server
+
+
+# read one JSON line from conn, or {} if the line isn't JSON
+def read_message(conn):
+    data = b''
+    while (not data.endswith(b'\n')):
+        chunk = conn.recv(65536)
+        if (not chunk):
+            break
+        data += chunk
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError:
+        return {}
+
+
+def send_message(conn, message):
+    conn.sendall((json.dumps(message, sort_keys=True) + '\n').encode('utf-8'))
+
+
+# send request to the daemon listening at socket_path and return its reply
+def send_request(socket_path, request):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    send_message(conn, request)
+    reply = read_message(conn)
+    conn.close()
+    return reply
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a fusedata filesystem checked from memory, or ask the daemon that does to check it.")
+    parser.add_argument('path', nargs='?', help="fusedata.N directory or single-file image to serve checks of (not needed with --request)")
+    parser.add_argument('--socket', required=True, metavar='FILE', help="Unix socket the daemon listens on")
+    parser.add_argument('--request', choices=['check', 'status', 'stop'], help="instead of starting a daemon, send this request to the one on --socket")
+    parser.add_argument('--check-only', action='store_true', help="with --request check: print the fixes as JSON lines instead of making them")
+    parser.add_argument('--poll', action='store_true', help="poll a fusedata.N directory for changed blocks instead of watching it with inotify")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N')
+    parser.add_argument('--order', choices=['dfs', 'bfs'], default='dfs')
+    parser.add_argument('--manifest', metavar='FILE', help="start from the manifest in FILE, and save the manifest of every check that writes its repairs there")
+    parser.add_argument('--journal', metavar='FILE', help="journal every check's repairs to FILE (see fsjournal.py)")
+    parser.add_argument('--sweep', action='store_true')
+    parser.add_argument('--lost-found', action='store_true')
+    parser.add_argument('--blocks', type=int, metavar='N')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, metavar='BYTES')
+    parser.add_argument('--free-end', type=int, metavar='N')
+    args = parser.parse_args()
+
+    if (args.request):
+        reply = send_request(args.socket, {'request': args.request, 'check_only': args.check_only})
+        if (args.request != 'check'):
+            print(json.dumps(reply, sort_keys=True))
+            return
+        if ('error' in reply):
+            sys.stderr.write("The check failed: %s\n" % reply['error'])
+        # print what csefsck.py would have
+        # a check that exited or failed has no fixes (and a request the daemon didn't understand has no messages either)
+        if (args.check_only):
+            sys.stderr.write(reply.get('messages', ''))
+            for fix in reply.get('fixes', []):
+                sys.stdout.write(json.dumps(fix, sort_keys=True) + '\n')
+        else:
+            sys.stdout.write(reply.get('messages', ''))
+            if ('exit' not in reply):
+                print("%d bytes written to %d blocks.\n" % (reply['bytes_written'], reply['blocks_written']))
+        sys.exit(reply.get('exit') or 0)
+
+    if (not args.path):
+        parser.error("the daemon needs the path of the filesystem to check")
+    options = {'jobs': args.jobs, 'order': args.order, 'max_blocks': args.blocks, 'block_size': args.block_size, 'free_end': args.free_end,
+               'sweep': args.sweep, 'lost_found': args.lost_found, 'journal_path': args.journal}
+    daemon = CheckDaemon(args.path, options, args.manifest, args.poll, args.block_size)
+    print("Checking %s on request at %s (changed blocks found by %s).\n" % (args.path, args.socket, daemon.watcher.kind))
+    sys.stdout.flush()
+    daemon.serve(args.socket)
+
+
+# run main() when fsdaemon.py is executed
+if __name__ == "__main__":
+    main()
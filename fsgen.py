@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+'''
+
+    Synthetic fusedata filesystem generator
+
+    Writes a valid filesystem image (either layout, see blockdev.py) of any size for testing and benchmarking csefsck.py,
+    and can inject the kinds of corruption the checker repairs.
+
+    Layout
+    ----------------------------------------------------------------------------------------------------------------------
+        fusedata.0                          superblock
+        FREE_START .. freeEnd               free block list, BLOCKS_IN_FREE block numbers per block (scaled to the block size)
+        root = freeEnd + 1                  root directory
+                                            (the layout of csefsck.Geometry(blocks, block_size), so the checker reads it back from the superblock)
+        root + 1 ..                         directories (depth levels of fanout sub-directories each), then file inodes,
+                                            each followed by its location block (data, or an index block and its data blocks)
+    ----------------------------------------------------------------------------------------------------------------------
+    freeEnd grows with the number of blocks so every free block fits on the free list.
+    The data blocks of indirect files only hold a short marker; the checker never reads them.
+
+    Corruption
+    ----------------------------------------------------------------------------------------------------------------------
+        --future-times N    N directories/inodes get an mtime in the future
+        --bad-dots N        N directories get a wrong '.' or '..' block number
+        --bad-indirect N    N file inodes get the wrong indirect flag
+        --leaked N          N unreferenced blocks hold data and are missing from the free list
+    ----------------------------------------------------------------------------------------------------------------------
+
+    Example
+        python fsgen.py /tmp/fs.img --blocks 100000 --block-size 1024 --depth 3 --fanout 8 --files 5000 --indirect-ratio 0.3 --future-times 10
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+
+from blockdev import DirDevice, ImageDevice
+from fsparse import Superblock, DirInode, FileInode, serialize_index_block
+from csefsck import Geometry, BLOCK_SIZE, DEV_ID, UID, GID, INODE_MODE, DIR_UID, DIR_GID, DIR_MODE
+
+BASE_TIME = 1323630836 # atime/ctime/mtime of everything that isn't corrupted
+FUTURE    = 2000000000 # an mtime in the future
+
+
+def new_dir(my_num, parent_num):
+    record = DirInode()
+    (record.size, record.uid, record.gid, record.mode) = (0, DIR_UID, DIR_GID, DIR_MODE)
+    (record.atime, record.ctime, record.mtime) = (BASE_TIME, BASE_TIME, BASE_TIME)
+    record.entries = [(b'd', b'.', my_num), (b'd', b'..', parent_num)]
+    return record
+
+
+def new_file_inode(size, indirect, location):
+    record = FileInode()
+    (record.size, record.uid, record.gid, record.mode, record.linkcount) = (size, UID, GID, INODE_MODE, 1)
+    (record.atime, record.ctime, record.mtime) = (BASE_TIME, BASE_TIME, BASE_TIME)
+    (record.indirect, record.location) = (indirect, location)
+    return record
+
+
+'''
+Writes a filesystem of num_blocks blocks of block_size bytes to device and returns a dict describing it (geometry, counts, and the blocks that were corrupted).
+Raises ValueError, before anything is written, if the tree doesn't fit in num_blocks or a block doesn't fit in block_size.
+'''
+def generate(device, num_blocks, depth=2, fanout=4, files=100, indirect_ratio=0.25, max_data_blocks=8,
+             future_times=0, bad_dots=0, bad_indirect=0, leaked=0, seed=0, block_size=BLOCK_SIZE):
+    rng = random.Random(seed)
+    layout = Geometry(num_blocks, block_size)
+    (free_start, free_end, root) = (layout.free_start, layout.free_end, layout.root)
+    next_block = [root + 1]
+
+    # hand out the next unused block number
+    def allocate():
+        num = next_block[0]
+        if (num >= num_blocks):
+            raise ValueError("the filesystem doesn't fit in %d blocks" % num_blocks)
+        next_block[0] += 1
+        return num
+
+    # directories, level by level
+    dirs = {root: new_dir(root, root)}
+    level = [root]
+    for i in range(0, depth):
+        next_level = []
+        for parent_num in level:
+            for j in range(0, fanout):
+                my_num = allocate()
+                dirs[my_num] = new_dir(my_num, parent_num)
+                dirs[parent_num].entries.append((b'd', b"d%d" % j, my_num))
+                next_level.append(my_num)
+        level = next_level
+    dir_nums = sorted(dirs)
+
+    # file inodes, spread over the directories round robin
+    inodes = {}
+    data = {} # block number --> contents of location, index, and data blocks
+    for i in range(0, files):
+        my_num = allocate()
+        location = allocate()
+        if (rng.random() < indirect_ratio):
+            blocks = [allocate() for k in range(0, rng.randint(1, max_data_blocks))]
+            size = rng.randint(block_size * (len(blocks) - 1) + 1, block_size * len(blocks))
+            data[location] = serialize_index_block(blocks)
+            for k in blocks:
+                data[k] = b"data of fusedata.%d" % my_num
+            inodes[my_num] = new_file_inode(size, 1, location)
+        else:
+            contents = (b"file %d " % i * rng.randint(1, 40))[0:block_size - 1]
+            data[location] = contents
+            inodes[my_num] = new_file_inode(len(contents), 0, location)
+        dirs[dir_nums[i % len(dir_nums)]].entries.append((b'f', b"f%d" % i, my_num))
+    for record in dirs.values():
+        record.linkcount = len(record.entries)
+
+    # corruption
+    corrupted = {'future_times': [], 'bad_dots': [], 'bad_indirect': [], 'leaked': []}
+    for my_num in rng.sample(dir_nums + sorted(inodes), min(future_times, len(dirs) + len(inodes))):
+        (dirs.get(my_num) or inodes.get(my_num)).mtime = FUTURE
+        corrupted['future_times'].append(my_num)
+    for my_num in rng.sample(dir_nums, min(bad_dots, len(dirs))):
+        entries = dirs[my_num].entries
+        k = rng.randint(0, 1) # entries 0 and 1 are '.' and '..'
+        entries[k] = (entries[k][0], entries[k][1], entries[k][2] + 1)
+        corrupted['bad_dots'].append(my_num)
+    for my_num in rng.sample(sorted(inodes), min(bad_indirect, len(inodes))):
+        inodes[my_num].indirect = 1 - inodes[my_num].indirect
+        corrupted['bad_indirect'].append(my_num)
+    for k in range(0, leaked):
+        num = allocate()
+        data[num] = b"leaked data"
+        corrupted['leaked'].append(num)
+
+    # serialize everything, so a block that doesn't fit in block_size is reported before anything is written
+    superblock = Superblock()
+    (superblock.creation_time, superblock.mounted, superblock.dev_id) = (BASE_TIME, 1, DEV_ID)
+    (superblock.free_start, superblock.free_end, superblock.root, superblock.max_blocks) = (free_start, free_end, root, num_blocks)
+    blocks = [(0, superblock.serialize())]
+    free_lists = [[] for i in range(free_start, free_end + 1)]
+    for k in range(next_block[0], num_blocks):
+        free_lists[k // layout.blocks_in_free].append(k)
+    blocks.extend([(free_start + i, serialize_index_block(free_lists[i])) for i in range(0, len(free_lists))])
+    blocks.extend([(my_num, record.serialize()) for (my_num, record) in dirs.items()])
+    blocks.extend([(my_num, record.serialize()) for (my_num, record) in inodes.items()])
+    blocks.extend(data.items())
+    for (num, contents) in blocks:
+        if (len(contents) <= block_size):
+            continue
+        if (num in dirs):
+            raise ValueError("directory fusedata.%d has %d entries and takes %d bytes, more than the %d byte block size; use a larger --block-size, more --fanout or --depth, or fewer --files"
+                             % (num, len(dirs[num].entries), len(contents), block_size))
+        raise ValueError("fusedata.%d takes %d bytes, more than the %d byte block size; use a larger --block-size or a smaller --max-data-blocks" % (num, len(contents), block_size))
+
+    # write everything out
+    for (num, contents) in blocks:
+        device.write(num, contents)
+
+    return {'blocks': num_blocks, 'block_size': block_size, 'free_start': free_start, 'free_end': free_end, 'root': root, 'dirs': len(dirs), 'files': len(inodes),
+            'used_blocks': next_block[0], 'corrupted': corrupted}
+
+
+# create path as an image file, or as a fusedata.N directory if layout is 'dir', and return its device
+def create_device(path, num_blocks, layout, block_size=BLOCK_SIZE):
+    if (layout == 'dir'):
+        if (not os.path.isdir(path)):
+            os.makedirs(path)
+        return DirDevice(path)
+    return ImageDevice.create(path, num_blocks, block_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic fusedata filesystem for testing and benchmarking csefsck.py.")
+    parser.add_argument('path', help="image file (or directory with --layout dir) to create")
+    parser.add_argument('--layout', choices=['image', 'dir'], default='image', help="single image file or fusedata.N directory (default: image)")
+    parser.add_argument('--blocks', type=int, default=10000, help="blocks in the filesystem (default: 10000)")
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, help="bytes per block (default: %d)" % BLOCK_SIZE)
+    parser.add_argument('--depth', type=int, default=2, help="levels of sub-directories below root (default: 2)")
+    parser.add_argument('--fanout', type=int, default=4, help="sub-directories per directory (default: 4)")
+    parser.add_argument('--files', type=int, default=100, help="file inodes (default: 100)")
+    parser.add_argument('--indirect-ratio', type=float, default=0.25, help="fraction of files that use an index block (default: 0.25)")
+    parser.add_argument('--max-data-blocks', type=int, default=8, help="most data blocks an indirect file points to (default: 8)")
+    parser.add_argument('--future-times', type=int, default=0, metavar='N')
+    parser.add_argument('--bad-dots', type=int, default=0, metavar='N')
+    parser.add_argument('--bad-indirect', type=int, default=0, metavar='N')
+    parser.add_argument('--leaked', type=int, default=0, metavar='N')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    device = create_device(args.path, args.blocks, args.layout, args.block_size)
+    try:
+        summary = generate(device, args.blocks, args.depth, args.fanout, args.files, args.indirect_ratio, args.max_data_blocks,
+                           args.future_times, args.bad_dots, args.bad_indirect, args.leaked, args.seed, args.block_size)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        device.close()
+    print("Wrote %d directories and %d files (%d of %d blocks used) to %s.\n" % (summary['dirs'], summary['files'], summary['used_blocks'], args.blocks, args.path))
+
+
+# run main() when fsgen.py is executed
+if __name__ == "__main__":
+    main()
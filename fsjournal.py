@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+
+    Write-ahead repair journal
+
+    The checker never writes a block while it checks: every repair (superblock fields, '.' and '..', link counts, indirect and size,
+    truncated locations, the free block list) only changes the BlockCache, and flush() writes the changed blocks back at the end of the run.
+    With a journal file, flush() first saves the journal, the old and the new contents of every block it is about to write, and only then
+    writes the blocks. A run killed while writing leaves the journal behind, so the half written repairs can be finished or rolled back:
+
+        python csefsck.py fs.img --journal fs.journal       check, journaling the repairs before they are written
+        python csefsck.py fs.img --replay fs.journal        write the new contents of every block in the journal again
+        python csefsck.py fs.img --undo fs.journal          write back the old contents, as they were before the repairs
+
+    A check run with --journal replays an unfinished journal at the same path before it starts. Replaying writes whole blocks,
+    so it can be run any number of times. Neither one touches a filesystem whose blocks hold something other than the journal's
+    old or new contents (i.e. a different filesystem, or one that was changed since), and undo refuses once a later run has rewritten a block.
+
+    The journal is a text file of JSON lines: a header, one line per block with its old and new contents as base64, and a 'committed' line,
+    all written to a temporary file, synced, and renamed into place, so a journal is either complete or not there at all.
+    Each state it goes through after that is appended as a line of its own:
+        committed   the blocks may be partly written
+        applied     every new block was written and synced
+        undone      every old block was written back and synced
+    A block that didn't exist before the repairs (a fusedata file that was never written) is undone by writing it empty.
+
+'''
+
+from base64 import b64encode, b64decode
+from time import time
+import json
+import os
+
+JOURNAL_VERSION = 1
+
+
+# write the text lines to the end of path (or a new file) and sync them to disk
+def append_lines(path, lines, mode='a'):
+    fh = open(path, mode)
+    fh.write(''.join([json.dumps(line, sort_keys=True) + '\n' for line in lines]))
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+
+
+'''
+A journal at path: entries is a list of (block number, old contents, new contents) in block order, and state is
+None before it is committed, then 'committed', 'applied', or 'undone' (see the module docstring).
+'''
+class Journal(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.state = None
+
+    # save the old and new contents of every dirty block of cache; returns once they are safely on disk
+    def commit(self, cache):
+        self.entries = [(num, cache.original[num], cache.blocks[num]) for num in sorted(cache.dirty)]
+        lines = [{'version': JOURNAL_VERSION, 'blocks': len(self.entries)}]
+        lines.extend([{'block': num, 'old': b64encode(old).decode('ascii'), 'new': b64encode(new).decode('ascii')} for (num, old, new) in self.entries])
+        lines.append({'state': 'committed', 'time': int(time())})
+        tmp_path = self.path + '.tmp'
+        append_lines(tmp_path, lines, 'w')
+        os.rename(tmp_path, self.path)
+        # the rename itself only lasts once the directory holding the journal is synced
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        os.fsync(directory)
+        os.close(directory)
+        self.state = 'committed'
+
+    # record that the journal went into state
+    def mark(self, state):
+        append_lines(self.path, [{'state': state, 'time': int(time())}])
+        self.state = state
+
+    # return the journal saved at path, or None if there is none (or it can't be read)
+    @classmethod
+    def load(cls, path):
+        journal = cls(path)
+        try:
+            fh = open(path, 'r')
+            lines = [json.loads(line) for line in fh if (line.strip())]
+            fh.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if (not lines or lines[0].get('version') != JOURNAL_VERSION):
+            return None
+        blocks = lines[0]['blocks']
+        journal.entries = [(line['block'], b64decode(line['old']), b64decode(line['new'])) for line in lines[1:blocks + 1]]
+        states = [line['state'] for line in lines[blocks + 1:] if ('state' in line)]
+        if (len(journal.entries) != blocks or not states):
+            return None
+        journal.state = states[-1]
+        return journal
+
+    # return the block numbers whose contents on device are neither the old nor the new contents in the journal
+    def mismatches(self, device):
+        return [num for (num, old, new) in self.entries if ((device.read(num) or b'') not in (old, new))]
+
+    # write every block's new contents (or its old ones, with undo) to device, sync it, and record the new state
+    def apply(self, device, undo=False):
+        for (num, old, new) in self.entries:
+            device.write(num, old if (undo) else new)
+        device.sync()
+        self.mark('undone' if (undo) else 'applied')
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+'''
+
+    Block manifest for incremental checks
+
+    After a run, csefsck.py can save a manifest with the content hash of every directory and file inode block it checked
+    (plus each inode's location block) and what the check found in them:
+        directories:  parent block number, sub-directory block numbers, file inode block numbers
+        file inodes:  blocks the inode uses (its location block and any data blocks listed there), and how many directory entries link to it
+
+    On the next run a directory whose block hashes the same (and is reached from the same parent) doesn't need to be parsed
+    or checked again; its recorded sub-directories and file inodes are used instead. The same goes for a file inode whose
+    block and location block both hash the same and that has as many links as before (its linkcount is checked against them). Blocks are only hashed, never parsed, so an unchanged subtree costs one read per block.
+    The hashes are taken after the run's repairs, so a block the checker fixed is clean next time.
+
+'''
+
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 2
+
+
+# return the content hash of a block
+def block_hash(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+
+'''
+previous_dirs/previous_inodes hold what was loaded from the last run and are only used by unchanged_dir/unchanged_inode;
+dirs/inodes are filled in by record_dir/record_inode during this run and are what save() writes.
+'''
+class Manifest(object):
+    def __init__(self):
+        self.previous_dirs = {}
+        self.previous_inodes = {}
+        self.dirs = {}   # block number --> {'hash', 'parent', 'subdirs', 'files'}
+        self.inodes = {} # block number --> {'hash', 'location', 'location_hash', 'used', 'links'}
+        self.hashes = {} # block number --> (contents, their hash), so the same contents are only hashed once
+
+    # return the manifest saved at path, or an empty one if there is none (or it can't be read)
+    @classmethod
+    def load(cls, path):
+        manifest = cls()
+        try:
+            fh = open(path, 'r')
+            data = json.load(fh)
+            fh.close()
+        except (IOError, ValueError):
+            return manifest
+        if (data.get('version') != MANIFEST_VERSION):
+            return manifest
+        manifest.previous_dirs = dict([(int(num), entry) for (num, entry) in data['dirs'].items()])
+        manifest.previous_inodes = dict([(int(num), entry) for (num, entry) in data['inodes'].items()])
+        return manifest
+
+    # write the manifest to path (through a temporary file so a crash never leaves half a manifest)
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        fh = open(tmp_path, 'w')
+        json.dump({'version': MANIFEST_VERSION, 'dirs': self.dirs, 'inodes': self.inodes}, fh, sort_keys=True)
+        fh.close()
+        os.rename(tmp_path, path)
+
+    # return the recorded (subdirs, files) of directory num if its block is unchanged and it has the same parent, else None
+    def unchanged_dir(self, cache, num, parent_num):
+        entry = self.previous_dirs.get(num)
+        if (entry is None or entry['parent'] != parent_num or entry['hash'] != self.hash_of(cache, num)):
+            return None
+        return (entry['subdirs'], entry['files'])
+
+    # return the recorded used blocks of file inode num if its block and location block are unchanged and it still has links links, else None
+    def unchanged_inode(self, cache, num, links):
+        entry = self.previous_inodes.get(num)
+        if (entry is None or entry['links'] != links or entry['hash'] != self.hash_of(cache, num)):
+            return None
+        if (entry['location_hash'] != self.hash_of(cache, entry['location'])):
+            return None
+        return entry['used']
+
+    # record what the check found in directory num; the hash is filled in by finish()
+    def record_dir(self, num, parent_num, subdirs, files):
+        self.dirs[num] = {'hash': None, 'parent': parent_num, 'subdirs': list(subdirs), 'files': list(files)}
+
+    # record the blocks file inode num uses (used[0] is its location block) and its number of links; the hashes are filled in by finish()
+    def record_inode(self, num, used, links):
+        self.inodes[num] = {'hash': None, 'location': used[0], 'location_hash': None, 'used': list(used), 'links': links}
+
+    # return an empty manifest whose previous run is this one, as if this one had been saved and loaded again (for a check that stays in memory, see fsdaemon.py)
+    def carry_over(self):
+        manifest = Manifest()
+        manifest.previous_dirs = self.dirs
+        manifest.previous_inodes = self.inodes
+        manifest.hashes = self.hashes
+        return manifest
+
+    '''
+    Return the hash of block num as it is in cache. The hash is remembered along with the very contents it was taken of, so it is used again
+    for as long as the cache holds those contents: the unchanged blocks of a manifest kept in memory are hashed once, not on every check,
+    and a block that is repaired or read again from disk gets new contents and is hashed again.
+    '''
+    def hash_of(self, cache, num):
+        contents = cache.read(num)
+        known = self.hashes.get(num)
+        if (known is not None and known[0] is contents):
+            return known[1]
+        digest = block_hash(contents)
+        self.hashes[num] = (contents, digest)
+        return digest
+
+    # hash every recorded block as it is in cache at the end of the run, i.e. after the repairs
+    def finish(self, cache):
+        for (num, entry) in self.dirs.items():
+            entry['hash'] = self.hash_of(cache, num)
+        for (num, entry) in self.inodes.items():
+            entry['hash'] = self.hash_of(cache, num)
+            entry['location_hash'] = self.hash_of(cache, entry['location'])
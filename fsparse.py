@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+'''
+
+    Parser for fusedata blocks
+
+    Decodes the text stored in a fusedata block into a small record object and serializes it back.
+    The checkers in csefsck.py only look at these records, so none of them do their own string surgery.
+
+    Block formats
+    ----------------------------------------------------------------------------------------------------------------------------------------
+        superblock:  {creationTime: 1429434844, mounted: 5, devId:20, freeStart:1, freeEnd:25, root:26, maxBlocks:10000}
+        directory:   {size:1033, uid:1000, gid:1000, mode:16877, atime:1323630836, ctime:1323630836, mtime:1323630836, linkcount:4,
+                      filename_to_inode_dict: {f:hello.txt:27, d:.:26, d:..:26, d:test:30}}
+        file inode:  {size:11, uid:1, gid:1, mode:33261, linkcount:1, atime:1323630836, ctime:1323630836, mtime:1323630836, indirect:1 location:28}
+        index block: 36, 37, 38
+    ----------------------------------------------------------------------------------------------------------------------------------------
+
+    serialize() always writes the formats above, so a block already in that format comes back byte for byte
+    (and the block cache won't see it as changed).
+
+    A directory's filename_to_inode_dict is read in place: parse_dir finds where it starts and ends in the block and
+    iter_dir_entries walks it one entry at a time, so a huge directory isn't split or copied up front.
+    iter_serialize_dir_entries is the matching writer, yielding the entries back one piece at a time.
+
+    Blocks are bytes on Python 2 and 3 alike: every function here takes and returns bytes, and a directory entry's type and name are bytes too.
+
+    Fast paths: a superblock, file inode, or directory header laid out the way serialize() writes it is validated and has all its fields pulled out
+    by one precompiled regex (LAYOUT_RE), an index block is validated by one (INDEX_RE), and identify_block tells what a block holds from its first
+    non-blank byte, so only the one parser that can match is run. Anything else goes through the general parsers, which also give the error messages.
+
+'''
+
+import re
+
+
+# raised when the contents of a block don't match the format of the record it is being parsed as
+class BlockFormatError(ValueError):
+    pass
+
+
+# matches every "key:number" pair in a block, allowing whitespace around the ':'
+FIELD_RE = re.compile(br'(\w+)\s*:\s*(-?\d+)')
+
+DIR_DICT_KEY = b'filename_to_inode_dict'
+
+# a CSV list of block numbers, e.g. an index block or a free block list block
+INDEX_RE = re.compile(br'\s*\d+\s*(?:,\s*\d+\s*)*\Z')
+
+# the first non-blank byte of a block
+LEAD_RE = re.compile(br'\s*(\S)')
+
+
+'''
+Return a regex matching the fields keys (a tuple of (block key, attribute name) pairs) in that order, the way serialize() writes them
+(whitespace allowed around the ':' and between fields, commas between fields optional), capturing their values in the same order.
+With braces the whole block must be one pair of curly braces around them, as in a superblock or file inode; without, just the fields, as in a directory header.
+The parsers assign the captured values in the order of their class's KEYS.
+'''
+def layout_re(keys, braces=True):
+    fields = br'[\s,]+'.join([re.escape(key.encode('ascii')) + br'\s*:\s*(-?\d+)' for (key, attr) in keys])
+    if (braces):
+        return re.compile(br'\s*\{\s*' + fields + br'\s*\}\s*\Z')
+    return re.compile(br'\s*' + fields + br'[\s,]*\Z')
+
+# pull the numeric fields named in keys (a tuple of (block key, attribute name) pairs) out of text and set them on record
+def parse_fields(record, keys, text, num):
+    fields = dict(FIELD_RE.findall(text))
+    for (key, attr) in keys:
+        value = fields.get(key.encode('ascii'))
+        if (value is None):
+            raise BlockFormatError("fusedata.%d is missing its %s field" % (num, key))
+        setattr(record, attr, int(value))
+    return record
+
+
+# return (start, end) so text[start:end] is what is inside the curly braces around text[start:end] (ignoring whitespace), or raise BlockFormatError
+def brace_bounds(text, start, end, num):
+    # slices rather than indexes, since indexing bytes gives an int on Python 3
+    while (start < end and text[start:start + 1].isspace()):
+        start += 1
+    while (end > start and text[end - 1:end].isspace()):
+        end -= 1
+    if (end - start < 2 or text[start:start + 1] != b'{' or text[end - 1:end] != b'}'):
+        raise BlockFormatError("fusedata.%d is not enclosed in curly braces" % num)
+    return (start + 1, end - 1)
+
+
+# return text with exactly one pair of outer curly braces removed, or raise BlockFormatError
+def strip_braces(text, num):
+    text = text.strip()
+    if (not text.startswith(b'{') or not text.endswith(b'}')):
+        raise BlockFormatError("fusedata.%d is not enclosed in curly braces" % num)
+    return text[1:-1]
+
+
+# ------------------------------------------------- superblock ---------------------------------------------------- #
+
+class Superblock(object):
+    __slots__ = ('creation_time', 'mounted', 'dev_id', 'free_start', 'free_end', 'root', 'max_blocks')
+
+    KEYS = (('creationTime', 'creation_time'), ('mounted', 'mounted'), ('devId', 'dev_id'), ('freeStart', 'free_start'),
+            ('freeEnd', 'free_end'), ('root', 'root'), ('maxBlocks', 'max_blocks'))
+
+    def serialize(self):
+        return b"{creationTime: %d, mounted: %d, devId:%d, freeStart:%d, freeEnd:%d, root:%d, maxBlocks:%d}" % (
+            self.creation_time, self.mounted, self.dev_id, self.free_start, self.free_end, self.root, self.max_blocks)
+
+
+SUPERBLOCK_RE = layout_re(Superblock.KEYS)
+
+
+def parse_superblock(contents, num=0):
+    match = SUPERBLOCK_RE.match(contents)
+    if (match is not None):
+        record = Superblock()
+        (record.creation_time, record.mounted, record.dev_id, record.free_start, record.free_end, record.root, record.max_blocks) = map(int, match.groups())
+        return record
+    body = strip_braces(contents, num)
+    if (b'{' in body or b'}' in body):
+        raise BlockFormatError("fusedata.%d does not contain superblock data" % num)
+    return parse_fields(Superblock(), Superblock.KEYS, body, num)
+
+
+# ------------------------------------------------- directories --------------------------------------------------- #
+
+class DirInode(object):
+    # entries is a list of (type, name, block number) tuples, type being b'd' or b'f'
+    __slots__ = ('size', 'uid', 'gid', 'mode', 'atime', 'ctime', 'mtime', 'linkcount', 'entries')
+
+    KEYS = (('size', 'size'), ('uid', 'uid'), ('gid', 'gid'), ('mode', 'mode'), ('atime', 'atime'), ('ctime', 'ctime'),
+            ('mtime', 'mtime'), ('linkcount', 'linkcount'))
+
+    def serialize(self):
+        header = b"{size:%d, uid:%d, gid:%d, mode:%d, atime:%d, ctime:%d, mtime:%d, linkcount:%d, %s: {" % (
+            self.size, self.uid, self.gid, self.mode, self.atime, self.ctime, self.mtime, self.linkcount, DIR_DICT_KEY)
+        return header + b''.join(iter_serialize_dir_entries(self.entries)) + b'}}'
+
+
+DIR_HEADER_RE = layout_re(DirInode.KEYS, braces=False)
+
+
+# yield the directory entries (type, name, block number) in block format, separated by ', ', one piece at a time
+def iter_serialize_dir_entries(entries):
+    separator = b''
+    for entry in entries:
+        yield separator
+        yield b"%s:%s:%d" % entry
+        separator = b', '
+
+
+# split "type:name:block_number" into a tuple; the name sits between the first and last ':'
+def parse_dir_entry(text, num):
+    text = text.strip()
+    first = text.find(b':')
+    last = text.rfind(b':')
+    if (first <= 0 or last == first):
+        raise BlockFormatError("fusedata.%d has a malformed directory entry '%s'" % (num, text.decode('ascii', 'replace')))
+    entry_type = text[:first].strip()
+    block_str = text[last + 1:].strip()
+    if (entry_type not in (b'd', b'f') or not block_str.isdigit()):
+        raise BlockFormatError("fusedata.%d has a malformed directory entry '%s'" % (num, text.decode('ascii', 'replace')))
+    return (entry_type, text[first + 1:last], int(block_str))
+
+
+# yield the entries of the filename_to_inode_dict in text[start:end] (without its braces) as (type, name, block number) tuples, one at a time
+def iter_dir_entries(text, num, start=0, end=None):
+    if (end is None):
+        end = len(text)
+    while (start < end):
+        comma = text.find(b',', start, end)
+        if (comma < 0):
+            comma = end
+        entry = text[start:comma]
+        if (entry.strip()):
+            yield parse_dir_entry(entry, num)
+        start = comma + 1
+
+
+# find the bounds of the header and the filename_to_inode_dict in a directory block; only the (short) header is copied out of contents
+def parse_dir(contents, num):
+    (body_start, body_end) = brace_bounds(contents, 0, len(contents), num)
+    key = contents.find(DIR_DICT_KEY, body_start, body_end)
+    colon = key + len(DIR_DICT_KEY)
+    while (key >= 0 and colon < body_end and contents[colon:colon + 1].isspace()):
+        colon += 1
+    if (key < 0 or colon >= body_end or contents[colon:colon + 1] != b':'):
+        raise BlockFormatError("fusedata.%d does not contain directory data" % num)
+    (dict_start, dict_end) = brace_bounds(contents, colon + 1, body_end, num)
+    if (contents.find(b'{', body_start, key) >= 0 or contents.find(b'}', dict_start, dict_end) >= 0):
+        raise BlockFormatError("fusedata.%d does not contain directory data" % num)
+
+    header = contents[body_start:key]
+    match = DIR_HEADER_RE.match(header)
+    if (match is not None):
+        record = DirInode()
+        (record.size, record.uid, record.gid, record.mode, record.atime, record.ctime, record.mtime, record.linkcount) = map(int, match.groups())
+    else:
+        record = parse_fields(DirInode(), DirInode.KEYS, header, num)
+    record.entries = list(iter_dir_entries(contents, num, dict_start, dict_end))
+    return record
+
+
+# ------------------------------------------------- file inodes --------------------------------------------------- #
+
+class FileInode(object):
+    __slots__ = ('size', 'uid', 'gid', 'mode', 'linkcount', 'atime', 'ctime', 'mtime', 'indirect', 'location')
+
+    KEYS = (('size', 'size'), ('uid', 'uid'), ('gid', 'gid'), ('mode', 'mode'), ('linkcount', 'linkcount'), ('atime', 'atime'),
+            ('ctime', 'ctime'), ('mtime', 'mtime'), ('indirect', 'indirect'), ('location', 'location'))
+
+    def serialize(self):
+        return b"{size:%d, uid:%d, gid:%d, mode:%d, linkcount:%d, atime:%d, ctime:%d, mtime:%d, indirect:%d location:%d}" % (
+            self.size, self.uid, self.gid, self.mode, self.linkcount, self.atime, self.ctime, self.mtime, self.indirect, self.location)
+
+
+FILE_INODE_RE = layout_re(FileInode.KEYS)
+
+
+def parse_file_inode(contents, num):
+    match = FILE_INODE_RE.match(contents)
+    if (match is not None):
+        record = FileInode()
+        (record.size, record.uid, record.gid, record.mode, record.linkcount, record.atime, record.ctime, record.mtime, record.indirect, record.location) = map(int, match.groups())
+        return record
+    body = strip_braces(contents, num)
+    if (b'{' in body or b'}' in body or DIR_DICT_KEY in body):
+        raise BlockFormatError("fusedata.%d does not contain inode data" % num)
+    return parse_fields(FileInode(), FileInode.KEYS, body, num)
+
+
+# ------------------------------------------------- index blocks -------------------------------------------------- #
+
+# return the list of block numbers stored in an index block, or None if contents is not a CSV list of ints
+def parse_index_block(contents):
+    if (INDEX_RE.match(contents) is None):
+        return None
+    # int() skips the whitespace around each number itself
+    return list(map(int, contents.split(b',')))
+
+
+def serialize_index_block(blocks):
+    return b', '.join([b'%d' % i for i in blocks])
+
+
+# ------------------------------------------------ identifying blocks --------------------------------------------- #
+
+'''
+Return (kind, what it holds) for the contents of block number num, kind being 'directory' (with its DirInode), 'file-inode' (its FileInode),
+'index' (its list of block numbers), or 'data' (None). The first non-blank byte decides which parser is tried: a '{' is a directory if
+DIR_DICT_KEY is in the block and a file inode if not, a digit an index block, and anything else (or a block the parser rejects) is data.
+Parsing a directory or file inode never succeeds on a block the other parser would accept, so this is the same as trying every parser in turn.
+'''
+def identify_block(contents, num):
+    match = LEAD_RE.match(contents)
+    lead = match.group(1) if (match is not None) else b''
+    try:
+        if (lead == b'{'):
+            if (DIR_DICT_KEY in contents):
+                return ('directory', parse_dir(contents, num))
+            return ('file-inode', parse_file_inode(contents, num))
+    except BlockFormatError:
+        return ('data', None)
+    if (lead.isdigit()):
+        blocks = parse_index_block(contents)
+        if (blocks is not None):
+            return ('index', blocks)
+    return ('data', None)
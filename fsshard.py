@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''
+
+    Subtree-scoped and sharded checks
+
+    A Scope limits a check to part of the filesystem, so several processes or machines can split a very large one between them:
+        subtrees    only the directories reachable from the given directories are walked (by default the whole tree from root)
+        shards      the directories and file inodes are split into N shards by a hash of their block number; shard K only checks and repairs
+                    the ones that hash to K and only claims their blocks: a directory's or inode's own block is claimed by the shard it hashes to,
+                    the blocks an inode points to by the inode's shard
+    Every shard still walks all the directories in its subtrees, since an inode's link count is the number of entries pointing at it from anywhere,
+    but outside its shard a directory is only parsed for its entries. The file inodes, which are most of the work, are split between the shards.
+    In a subtree check, entries outside the subtrees can link to an inode too, so linkcounts are only checked to be at least 1.
+
+    A scoped check never writes to the filesystem. It saves a shard file instead, holding its scope, the fingerprint of the filesystem it checked,
+    its part of the block map (owners and cross links), and the new contents of the blocks it repaired. csefsck.py --merge then combines the shard
+    files: it applies every shard's repairs, combines their block maps (a block claimed in two shards is cross-linked), and, if the shards cover the
+    whole tree between them (no subtrees, and shards 0 .. N-1 of the same N), rewrites the free block list from the combined map.
+
+    Example, four machines checking one image:
+        python csefsck.py fs.img --shard 0/4 --shard-output shard0      (and 1/4, 2/4, 3/4 on the others)
+        python csefsck.py fs.img --merge shard0 shard1 shard2 shard3
+
+    A shard file is zlib compressed JSON, like a checkpoint (see fscheckpoint.py).
+
+'''
+
+from base64 import b64encode, b64decode
+import json
+import os
+import zlib
+
+from fscheckpoint import fingerprint, pack_array, unpack_array
+
+SHARD_VERSION = 1
+
+
+# return the shard (0 .. shards - 1) that block number num belongs to
+# a multiplicative hash rather than num % shards, since blocks are allocated in runs (an inode and its location block, say) that would all land in the same shards
+def shard_of(num, shards):
+    return ((num * 2654435761) & 0xffffffff) % shards
+
+
+'''
+The part of the filesystem a check covers: subtrees is a list of directory block numbers to walk from (None for the whole tree from root),
+and only the directories and file inodes in shard number shard of shards are checked (see shard_of).
+'''
+class Scope(object):
+    def __init__(self, subtrees=None, shard=0, shards=1):
+        self.subtrees = subtrees
+        self.shard = shard
+        self.shards = shards
+
+    # return the scope of --subtree (a list of block numbers, or None) and --shard ('K/N', or None); raises ValueError if shard_text is malformed
+    @classmethod
+    def parse(cls, subtrees, shard_text):
+        (shard, shards) = (0, 1)
+        if (shard_text):
+            try:
+                (shard, shards) = [int(part) for part in shard_text.split('/')]
+            except ValueError:
+                raise ValueError("--shard must be K/N, e.g. 0/4")
+            if (shards < 1 or shard < 0 or shard >= shards):
+                raise ValueError("--shard K/N needs 0 <= K < N")
+        return cls(subtrees or None, shard, shards)
+
+    # return True if directory or file inode num is checked in this scope
+    def owns(self, num):
+        return (self.shards == 1 or shard_of(num, self.shards) == self.shard)
+
+    # return the scope as a dict that can be saved as JSON
+    def describe(self):
+        return {'subtrees': self.subtrees, 'shard': self.shard, 'shards': self.shards}
+
+
+# return True if the scopes (describe() dicts) cover the whole tree between them: no subtrees, and every shard of the same number of shards
+def covers_filesystem(scopes):
+    if (not scopes or any([scope['subtrees'] is not None for scope in scopes])):
+        return False
+    shards = scopes[0]['shards']
+    return (all([scope['shards'] == shards for scope in scopes]) and set([scope['shard'] for scope in scopes]) == set(range(0, shards)))
+
+
+# write what the check in scope found to path: its block_map and the blocks it repaired in cache (whose geometry must be loaded)
+def save_shard(path, scope, cache, block_map):
+    shard = {'version': SHARD_VERSION, 'scope': scope.describe(), 'fingerprint': fingerprint(cache),
+             'owners': pack_array(block_map.owners), 'cross_links': [[num, owners] for (num, owners) in block_map.cross_links.items()],
+             'repaired': [[num, b64encode(cache.blocks[num]).decode('ascii')] for num in sorted(cache.dirty)]}
+    tmp_path = path + '.tmp'
+    fh = open(tmp_path, 'wb')
+    fh.write(zlib.compress(json.dumps(shard).encode('utf-8')))
+    fh.close()
+    os.rename(tmp_path, path)
+
+
+# return the shard saved at path, with its owners unpacked to an array and its repaired blocks decoded, or None if it can't be read
+def load_shard(path):
+    try:
+        fh = open(path, 'rb')
+        shard = json.loads(zlib.decompress(fh.read()).decode('utf-8'))
+        fh.close()
+    except (IOError, OSError, ValueError, zlib.error):
+        return None
+    if (shard.get('version') != SHARD_VERSION):
+        return None
+    shard['owners'] = unpack_array(shard['owners'])
+    shard['repaired'] = [(num, b64decode(contents)) for (num, contents) in shard['repaired']]
+    return shard
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+'''
+
+    Instrumentation for csefsck.py
+
+    Stats records the wall time of every phase of a check. With timing switched on (csefsck.py --stats) it also wraps
+    the block device's read/write and the block parsers so the time spent in I/O and in parsing is counted separately.
+    Nothing is wrapped unless instrument() is called, so a normal run only pays for a couple of time() calls per phase.
+
+'''
+
+from contextlib import contextmanager
+from time import time
+
+
+class Stats(object):
+    def __init__(self):
+        self.phases = []  # (phase name, seconds) in the order the phases ran
+        self.timers = {}  # timer name --> [calls, seconds]
+        self.fields = None # distribution of the directories' and inodes' times and ids (see csefsck.FieldColumns.summary)
+        self.orphans = None # kind --> number of unreachable blocks holding data, if the check swept for them (see csefsck.sweep_orphans)
+
+    # time the body of a with statement as the phase called name
+    @contextmanager
+    def phase(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time() - start))
+
+    # return func wrapped so every call is counted and timed under the timer called name
+    def timed(self, name, func):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        def wrapper(*args, **kwargs):
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer[0] += 1
+                timer[1] += time() - start
+        return wrapper
+
+    '''
+    For the body of a with statement, wrap device.read and device.write in the 'io_read' and 'io_write' timers, and every function in namespace
+    (a module's globals()) named in parsers in the 'parse' timer; the originals are put back when the body ends, so runs don't stack wrappers.
+    Nothing is wrapped unless enabled. Calls made in --jobs worker processes aren't counted (they only show up in their phase's time).
+    '''
+    @contextmanager
+    def instrument(self, device, namespace, parsers, enabled=True):
+        if (not enabled):
+            yield
+            return
+        (read, write) = (device.read, device.write)
+        originals = dict([(name, namespace[name]) for name in parsers])
+        device.read = self.timed('io_read', read)
+        device.write = self.timed('io_write', write)
+        for name in parsers:
+            namespace[name] = self.timed('parse', originals[name])
+        try:
+            yield
+        finally:
+            (device.read, device.write) = (read, write)
+            namespace.update(originals)
+
+    # return a dict summarizing the run, with the I/O counters of cache (a csefsck.BlockCache)
+    def summary(self, cache):
+        result = {'phases': dict(self.phases), 'total_secs': sum([secs for (name, secs) in self.phases]),
+                  'blocks_read': cache.blocks_read, 'bytes_read': cache.bytes_read,
+                  'blocks_written': cache.blocks_written, 'bytes_written': cache.bytes_written}
+        for (name, (calls, secs)) in self.timers.items():
+            result[name + '_calls'] = calls
+            result[name + '_secs'] = secs
+        if (self.fields is not None):
+            result['fields'] = self.fields
+        if (self.orphans is not None):
+            result['orphans'] = self.orphans
+        return result